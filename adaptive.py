@@ -0,0 +1,80 @@
+import math
+import numpy as np
+import fieldmap
+from leastsq import fitScan, ScanModel, bpmSigma
+
+# Adaptive choice of phase-scan points.
+#
+# After a few points spread over the scan range the scan is refitted after
+# every measurement. The next phase is the remaining grid point where the
+# fitted model is least certain, i.e. where the predicted BPM phase has the
+# largest variance j^T Cov j under the current (c, phase_in, offset)
+# covariance; for a linearised Gaussian model that is also where a
+# measurement gains the most information. The scan stops once the residual
+# spread and the parameter uncertainties meet their targets. Given num_read,
+# the readings averaged per point, the fits are weighted by leastsq.bpmSigma
+# of the BPM rms, with model_sigma added in quadrature, and the covariance
+# follows from those sigmas instead of the residual spread.
+
+class AdaptivePlan(object):
+    def __init__(self, candidates, first_phase, Win, distance, fieldName, slope, initial=4, min_points=6,
+                 target_error=1., target_phase=1., target_amplitude=0.02, num_read=None, model_sigma=0.):
+        self.candidates = list(candidates)
+        self.first_phase = first_phase
+        self.Win = Win
+        self.distance = distance
+        self.slope = slope
+        self.l, self.dz, self.Ez = fieldmap.load(fieldName)
+        self.initial = [self.candidates[int(round(k * (len(self.candidates) - 1.) / max(initial - 1, 1)))] for k in range(initial)]
+        self.min_points = max(min_points, initial)
+        self.target_error = target_error
+        self.target_phase = target_phase
+        self.target_amplitude = target_amplitude
+        self.num_read = num_read
+        self.model_sigma = model_sigma
+        self.p = np.array([1., 0., 0.])
+        self.cov = None
+        self.error = np.inf
+
+    def abscissa(self, phases):
+        return -(np.asarray(phases, dtype=float) - self.first_phase) * math.pi / 180 * self.slope
+
+    def update(self, x, y, errors=None):
+        xs = self.abscissa(x)
+        sigma = None
+        if self.num_read and errors is not None:
+            sigma = bpmSigma(errors, self.num_read, self.model_sigma)
+        self.p = fitScan(xs, y, self.Win, self.distance, self.l, self.dz, self.Ez, self.p, sigma=sigma)
+        model = ScanModel(y, self.Win, self.distance, self.l, self.dz, self.Ez, xs, sigma=sigma)
+        err = model.residuals(self.p)
+        self.error = np.std(err if sigma is None else err / model.weight)
+        self.cov = model.covariance(self.p)[0]
+
+    def uncertainties(self):
+        # 1-sigma of the relative amplitude and of the cavity phase [deg]
+        return math.sqrt(self.cov[0, 0]) / abs(self.p[0]), math.sqrt(self.cov[1, 1]) * 180 / math.pi / self.slope
+
+    def converged(self, n):
+        if n < self.min_points or not np.all(np.isfinite(self.cov)):
+            return False
+        amplitude, phase = self.uncertainties()
+        return self.error <= self.target_error and phase <= self.target_phase and amplitude <= self.target_amplitude
+
+    def next_phase(self, x, y, errors):
+        remaining = [phase for phase in self.candidates if phase not in x]
+        if not remaining:
+            return None
+        if len(x) < len(self.initial):
+            return [phase for phase in self.initial if phase not in x][0]
+        self.update(x, y, errors)
+        if self.converged(len(x)):
+            return None
+        jac = ScanModel(np.zeros(len(remaining)), self.Win, self.distance, self.l, self.dz, self.Ez, self.abscissa(remaining)).jacobian(self.p)
+        variance = np.einsum('ij,jk,ik->i', jac, self.cov, jac)
+        return remaining[int(np.argmax(variance))]
+
+    def skip(self, phase):
+        # a phase that could not be measured is not offered again
+        self.candidates.remove(phase)
+        if phase in self.initial:
+            self.initial.remove(phase)
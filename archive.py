@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import numpy as np
+
+# Append-only binary archive of phase scans.
+#
+# Every run gets its own directory under the archive root holding, per
+# cavity, a '<cavity>.samples' file with every raw BPM sample and a
+# '<cavity>.points' file with the per-point averages. Both are flat arrays
+# of fixed-size records, appended and flushed as the scan goes, so a crash
+# loses at most the point in progress; readers memory-map them. The root
+# 'index.jsonl' gets one line per run and per finished cavity, so runs can
+# be listed and filtered without opening the data files; a line torn by a
+# crash is skipped. A cavity line lists under 'polled' the points whose
+# samples were polled from a BPM that stopped updating rather than taken
+# from its monitor.
+
+sample_dtype = np.dtype([('point', '<i4'), ('setpoint', '<f8'), ('readback', '<f8'), ('timestamp', '<f8'), ('phase', '<f8'), ('used', 'u1')])
+point_dtype = np.dtype([('point', '<i4'), ('setpoint', '<f8'), ('readback', '<f8'), ('timestamp', '<f8'), ('mean', '<f8'), ('std', '<f8'), ('samples', '<i4')])
+
+def appendIndex(root, entry):
+    f = open(os.path.join(root, 'index.jsonl'), 'ab+')
+    # end a line torn by a crash, so only that entry is lost
+    f.seek(0, 2)
+    if f.tell():
+        f.seek(-1, 2)
+        if f.read(1) != b'\n':
+            f.write(b'\n')
+    f.write((json.dumps(entry) + '\n').encode('utf-8'))
+    f.close()
+
+class CavityWriter(object):
+    def __init__(self, run, cavity):
+        self.run = run
+        self.cavity = cavity
+        self.points = 0
+        self.polled = []
+        self.sample_file = open(os.path.join(run.path, cavity + '.samples'), 'ab')
+        self.point_file = open(os.path.join(run.path, cavity + '.points'), 'ab')
+
+    def append(self, setpoint, readback, mean, std, samples, used, polled=0):
+        # samples: (timestamp, phase) rows behind one scan point; polled: how
+        # many of them were polled
+        samples = np.asarray(samples, dtype=float).reshape(-1, 2)
+        rows = np.zeros(len(samples), dtype=sample_dtype)
+        rows['point'] = self.points
+        rows['setpoint'] = setpoint
+        rows['readback'] = np.nan if readback is None else readback
+        rows['timestamp'] = samples[:, 0]
+        rows['phase'] = samples[:, 1]
+        rows['used'] = used
+        self.sample_file.write(rows.tobytes())
+        self.sample_file.flush()
+
+        point = np.zeros(1, dtype=point_dtype)
+        point['point'] = self.points
+        point['setpoint'] = setpoint
+        point['readback'] = rows['readback'][0] if len(rows) else np.nan
+        point['timestamp'] = time.time()
+        point['mean'] = mean
+        point['std'] = std
+        point['samples'] = len(rows)
+        self.point_file.write(point.tobytes())
+        self.point_file.flush()
+        if polled:
+            self.polled.append(self.points)
+        self.points += 1
+
+    def close(self, **result):
+        self.sample_file.close()
+        self.point_file.close()
+        entry = dict(run=self.run.name, cavity=self.cavity, points=self.points, time=time.time())
+        if self.polled:
+            entry['polled'] = self.polled
+        entry.update(result)
+        appendIndex(self.run.root, entry)
+
+class RunWriter(object):
+    def __init__(self, root, **meta):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        stamp = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.name = stamp
+        n = 0
+        while os.path.exists(os.path.join(root, self.name)):
+            n += 1
+            self.name = '%s-%d' % (stamp, n)
+        self.path = os.path.join(root, self.name)
+        os.mkdir(self.path)
+        meta = dict(meta, run=self.name, time=time.time())
+        f = open(os.path.join(self.path, 'run.json'), 'w')
+        json.dump(meta, f)
+        f.close()
+        appendIndex(root, meta)
+
+    def cavity(self, name):
+        return CavityWriter(self, name)
+
+class Archive(object):
+    def __init__(self, root):
+        self.root = root
+
+    def index(self):
+        path = os.path.join(self.root, 'index.jsonl')
+        if not os.path.exists(path):
+            return []
+        entries = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a line torn by a crash while appending
+                    continue
+        return entries
+
+    def runs(self, since=None, until=None):
+        return [e for e in self.index() if 'cavity' not in e and (since is None or e['time'] >= since) and (until is None or e['time'] <= until)]
+
+    def cavities(self, cavity=None, run=None):
+        # finished cavity scans, oldest first
+        return [e for e in self.index() if 'cavity' in e and (cavity is None or e['cavity'] == cavity) and (run is None or e['run'] == run)]
+
+    def read(self, run, cavity, kind, dtype):
+        path = os.path.join(self.root, run, '%s.%s' % (cavity, kind))
+        size = os.path.getsize(path) // dtype.itemsize
+        if size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(size,))
+
+    def samples(self, run, cavity):
+        return self.read(run, cavity, 'samples', sample_dtype)
+
+    def points(self, run, cavity):
+        return self.read(run, cavity, 'points', point_dtype)
+
+    def scan(self, run, cavity):
+        # x, y, errors lists as WorkThread.scan returns them, for refitting
+        points = self.points(run, cavity)
+        return list(points['setpoint']), list(points['mean']), list(points['std'])
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import numpy as np
+import scipy.constants as C
+import fieldmap
+import leastsq
+import ttf
+
+# Benchmark and accuracy check of the leastsq.py physics kernels.
+#
+# Synthetic phase scans are generated from the model itself for a buncher
+# and an HWR field map over a range of injection energies. Each stage is
+# timed and the tracking passes it needs are counted; fitted results are
+# compared with the known truth and with a 10x finer field resampling, and
+# the batched kernels with the original scalar loops. Results are written
+# as JSON; --compare prints the speed-up against an earlier results file.
+# --startup instead times the cold import of the entry-point modules, each in
+# a fresh interpreter, and fails if the scanner or the GUI exceeds the budget
+# or imports the fit or plotting stack up front.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+startupModules = ['telemetry', 'lattice', 'fitcache', 'scanner', 'refit', 'leastsq', 'phasescan']
+# the entry points leave the deferred modules to the first fit or plot
+entryPoints = ['scanner', 'phasescan']
+deferred = ['scipy.optimize', 'scipy.stats', 'matplotlib', 'leastsq']
+heavy = ['scipy.optimize', 'scipy.stats', 'matplotlib', 'leastsq', 'wx', 'epics']
+
+def legacyCalTraceWinPhase(Win, c, phase_in, distance, l, dz, Ez):
+    # the original scalar loop, kept as the equivalence reference
+    mass, w = leastsq.mass, leastsq.w
+    W = Win
+    t = 0
+    a = 0
+    b = 0
+    for i in range(l - 1):
+        gamma = W / mass + 1
+        beta = (1 - gamma**-2)**0.5
+        phi = phase_in + 2 * C.pi * w * (t + 0.5 * dz / ( beta * C.c))
+        W = W +  c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
+        gammaExit = W / mass + 1
+        betaExit = (1 - gammaExit ** -2) ** 0.5
+        a += c * 0.5 * (Ez[i] + Ez[i+1]) * np.sin(phi) * dz
+        b += c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
+        t += dz / (0.5 * (beta + betaExit) * C.c)
+    return math.atan2(a, b), a, b
+
+def legacyEnergyGain(Win, c, phase_in, distance, l, dz, Ez):
+    mass, w = leastsq.mass, leastsq.w
+    W = Win
+    t = 0
+    for i in range(l - 1):
+        phi = phase_in + 2 * C.pi * w * t
+        gamma = W / mass + 1
+        beta = (1 - gamma**-2)**0.5
+        W = W +  c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
+        gammaExit = W / mass + 1
+        betaExit = (1 - gammaExit ** -2) ** 0.5
+        t += dz / (0.5 * (beta + betaExit) * C.c)
+    t += distance / (betaExit * C.c)
+    return -(w * t) * 180 * 2
+
+def writeFieldMaps(directory):
+    # Gaussian single-gap buncher and two-gap HWR profiles, columns z Ex Ey Ez
+    z = np.linspace(0, 0.24, 241)
+    buncher = np.exp(-((z - 0.12) / 0.03) ** 2)
+    np.savetxt(os.path.join(directory, 'buncher_field.txt'), np.column_stack([z, 0 * z, 0 * z, buncher]))
+    z = np.linspace(0, 0.36, 721)
+    hwr = 5 * (np.exp(-((z - 0.12) / 0.03) ** 2) - np.exp(-((z - 0.24) / 0.03) ** 2))
+    np.savetxt(os.path.join(directory, 'Exyz.txt'), np.column_stack([z, 0 * z, 0 * z, hwr]))
+    return dict(buncher=os.path.join(directory, 'buncher_field.txt'), hwr=os.path.join(directory, 'Exyz.txt'))
+
+class Counter(object):
+    # counts calls of the tracking kernels by wrapping the module attributes
+    names = ['track', 'trackSensitivities']
+
+    def __enter__(self):
+        self.counts = dict((name, 0) for name in self.names)
+        self.saved = dict((name, getattr(leastsq, name)) for name in self.names)
+        for name in self.names:
+            setattr(leastsq, name, self.wrap(name, self.saved[name]))
+        return self
+
+    def wrap(self, name, function):
+        def counted(*args, **kw):
+            self.counts[name] += 1
+            return function(*args, **kw)
+        return counted
+
+    def __exit__(self, *exc):
+        for name in self.names:
+            setattr(leastsq, name, self.saved[name])
+
+def timed(function, *args, **kw):
+    with Counter() as counter:
+        start = time.time()
+        result = function(*args, **kw)
+        elapsed = time.time() - start
+    return result, dict(seconds=elapsed, **counter.counts)
+
+def benchCase(kind, fieldName, Win, c, phase_in, distance, slope, points, noise, seed, legacy):
+    rs = np.random.RandomState(seed)
+    step = 10 * C.pi / 180
+    cav_phases = list(-178 + 10 * np.arange(points))
+    x = -np.arange(points) * step * slope
+    fieldmap.clear()
+    (l, dz, Ez), load = timed(fieldmap.load, fieldName)
+    truth = leastsq.energyGain(Win, c, phase_in + x, distance, l, dz, Ez) + 20
+    bpm_phases = list(truth + rs.normal(0, noise, points))
+
+    stages = dict(load=load)
+    gain, stages['energyGain'] = timed(leastsq.energyGain, Win, c, phase_in + x, distance, l, dz, Ez)
+    tw, stages['calTraceWinPhase'] = timed(leastsq.calTraceWinPhase, Win, c, phase_in + x, distance, l, dz, Ez)
+    xopt, stages['getEntrPhase'] = timed(leastsq.getEntrPhase, -C.pi / 2, Win, c, distance, l, dz, Ez)
+    fit, stages['getTWPhase'] = timed(leastsq.getTWPhase, cav_phases, bpm_phases, Win, distance, -90, fieldName, step, cav_phases[0], slope, 1)
+    table, stages['ttf_table'] = timed(ttf.getTable, fieldName, l, dz, Ez)
+    fit_sur, stages['getTWPhase_surrogate'] = timed(leastsq.getTWPhase, cav_phases, bpm_phases, Win, distance, -90, fieldName, step, cav_phases[0], slope, 1, surrogate=True)
+
+    # reference: same scan, field map resampled ten times finer
+    fine = fieldmap.load(fieldName, 30000)
+    fineTruth = leastsq.energyGain(Win, c, phase_in + x, distance, *fine)
+    fineXopt = leastsq.getEntrPhase(-C.pi / 2, Win, c, distance, *fine)
+    truePhase = leastsq.phaseWrappingFunction((phase_in - xopt) * 180 / C.pi / slope + cav_phases[0], slope)
+    accuracy = dict(
+        rfPhase=float(fit[0]), rfPhase_true=float(truePhase), rfPhase_error=float(fit[0] - truePhase),
+        rfPhase_surrogate_error=float(fit_sur[0] - truePhase), amplitude_error=float(fit[2] - c),
+        model_vs_fine=float(np.ptp(truth - fineTruth)), entrance_phase_vs_fine=float(xopt - fineXopt),
+        fit_error=float(fit[3]))
+
+    # rk4 integrator against a converged rk4 pass
+    converged = -(leastsq.w * leastsq.rk4Track(Win, c, phase_in + x, distance, l, dz, Ez, 4096)[0]) * 180 * 2
+    leastsq.setIntegrator('rk4')
+    try:
+        steps = leastsq.rk4Steps(Win, l, dz, Ez)
+        gain_rk4, stages['energyGain_rk4'] = timed(leastsq.energyGain, Win, c, phase_in + x, distance, l, dz, Ez)
+        fit_rk4, stages['getTWPhase_rk4'] = timed(leastsq.getTWPhase, cav_phases, bpm_phases, Win, distance, -90, fieldName, step, cav_phases[0], slope, 1)
+    finally:
+        leastsq.setIntegrator('kick')
+    accuracy.update(
+        kick_vs_converged=float(np.abs(gain - converged).max()), rk4_vs_converged=float(np.abs(gain_rk4 - converged).max()),
+        rfPhase_rk4_error=float(fit_rk4[0] - truePhase), field_evaluations_kick=l - 1, field_evaluations_rk4=4 * steps)
+    result = dict(kind=kind, Win=Win, c=c, points=points, stages=stages, accuracy=accuracy)
+
+    if legacy:
+        # equivalence of the batched kernels with the scalar loops
+        sample = phase_in + x[::max(points // 6, 1)]
+        start = time.time()
+        old = [legacyEnergyGain(Win, c, p, distance, l, dz, Ez) for p in sample]
+        oldTw = [legacyCalTraceWinPhase(Win, c, p, distance, l, dz, Ez) for p in sample]
+        legacySeconds = (time.time() - start) / (2 * len(sample))
+        new = leastsq.energyGain(Win, c, sample, distance, l, dz, Ez)
+        newTw = leastsq.calTraceWinPhase(Win, c, sample, distance, l, dz, Ez)
+        result['legacy'] = dict(
+            seconds_per_trajectory=legacySeconds,
+            energyGain_max_diff=float(np.abs(np.array(old) - new).max()),
+            traceWin_b_max_diff=float(np.abs(np.array([e[2] for e in oldTw]) - newTw[2]).max()))
+    return result
+
+def run(fields, energies, points=36, noise=0.3, seed=0, legacy=True):
+    cases = dict(buncher=dict(c=1.5, distance=0.1, slope=1), hwr=dict(c=0.5, distance=0.1026, slope=0.95))
+    results = []
+    for kind in sorted(fields):
+        case = cases[kind]
+        for i, Win in enumerate(energies):
+            results.append(benchCase(kind, fields[kind], Win, case['c'], 0.7, case['distance'], case['slope'], points, noise, seed + i, legacy))
+    return dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(), created=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+
+def startupTimes(modules=startupModules, repeat=3):
+    # best-of-repeat import time of each module and the heavy modules it
+    # loads; modules that cannot be imported here (no wx or pyepics off the
+    # console machines) report the error instead, which checkStartup counts
+    # as a failure for the entry points
+    code = 'import sys, time, json; t = time.time(); import %s; sys.stdout.write(json.dumps([time.time() - t, [m for m in %r if m in sys.modules]]))'
+    results = {}
+    for module in modules:
+        runs = []
+        for i in range(repeat):
+            p = subprocess.Popen([sys.executable, '-c', code % (module, heavy)], cwd=basedir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            if p.returncode:
+                break
+            runs.append(json.loads(out.decode('utf-8')))
+        if runs:
+            results[module] = dict(seconds=min(run[0] for run in runs), loads=runs[0][1])
+        else:
+            results[module] = dict(error=err.decode('utf-8').strip().splitlines()[-1])
+    return results
+
+def checkStartup(results, budget):
+    problems = []
+    # an entry point that cannot be imported fails the check: its startup
+    # time is unknown, not within budget
+    for module, result in sorted(results.items()):
+        if module not in entryPoints:
+            continue
+        if 'error' in result:
+            problems.append('%s fails to import: %s' % (module, result['error']))
+            continue
+        if result['seconds'] > budget:
+            problems.append('%s takes %.3f s to import' % (module, result['seconds']))
+        early = [name for name in deferred if name in result['loads']]
+        if early:
+            problems.append('%s imports %s' % (module, ', '.join(early)))
+    return problems
+
+def compare(old, new):
+    # print the speed-up of every stage of matching cases
+    index = dict(((r['kind'], r['Win']), r) for r in old['results'])
+    for r in new['results']:
+        o = index.get((r['kind'], r['Win']))
+        if o is None:
+            continue
+        for stage in sorted(r['stages']):
+            if stage in o['stages']:
+                before, after = o['stages'][stage]['seconds'], r['stages'][stage]['seconds']
+                sys.stdout.write('%s\t%s\t%-22s %10.4f -> %10.4f s  x%.1f\n' % (r['kind'], r['Win'], stage, before, after, before / max(after, 1e-9)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time and check the phase-scan fit kernels.')
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument('--buncher-field', help='buncher field map (default: synthetic)')
+    parser.add_argument('--hwr-field', help='HWR field map (default: synthetic)')
+    parser.add_argument('--energies', type=float, nargs='+', default=[1.5, 2.1, 3.0, 5.0], help='injection energies [MeV]')
+    parser.add_argument('--points', type=int, default=36)
+    parser.add_argument('--no-legacy', action='store_true', help='skip the comparison with the scalar loops')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--startup', action='store_true', help='only time the cold import of the entry-point modules')
+    parser.add_argument('--startup-budget', type=float, default=0.5, help='startup: longest acceptable import of scanner and phasescan [sec]')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        results = startupTimes()
+        with open(args.output, 'w') as f:
+            json.dump(dict(python=platform.python_version(), created=time.strftime('%Y-%m-%dT%H:%M:%S'), startup=results), f, indent=1)
+        for module in startupModules:
+            result = results[module]
+            if 'error' in result:
+                sys.stdout.write('%-10s failed: %s\n' % (module, result['error']))
+            else:
+                sys.stdout.write('%-10s %.3f s\t%s\n' % (module, result['seconds'], ' '.join(result['loads'])))
+        problems = checkStartup(results, args.startup_budget)
+        for problem in problems:
+            sys.stdout.write('# %s\n' % problem)
+        return 1 if problems else 0
+
+    directory = tempfile.mkdtemp()
+    try:
+        fields = writeFieldMaps(directory)
+        if args.buncher_field:
+            fields['buncher'] = args.buncher_field
+        if args.hwr_field:
+            fields['hwr'] = args.hwr_field
+        results = run(fields, args.energies, args.points, legacy=not args.no_legacy)
+    finally:
+        shutil.rmtree(directory)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    for r in results['results']:
+        sys.stdout.write('%s\tWin=%s\tfit %.3f s (%d passes)\trfPhase error %.4f deg\trk4 fit %.3f s, model error %.1e vs %.1e deg\n' % (
+            r['kind'], r['Win'], r['stages']['getTWPhase']['seconds'], r['stages']['getTWPhase']['track'] + r['stages']['getTWPhase']['trackSensitivities'],
+            r['accuracy']['rfPhase_error'], r['stages']['getTWPhase_rk4']['seconds'], r['accuracy']['rk4_vs_converged'], r['accuracy']['kick_vs_converged']))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    sys.exit(main())
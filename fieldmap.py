@@ -0,0 +1,75 @@
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+# Process-wide store of resampled field maps.
+#
+# Entries are keyed by (absolute path, mtime, points), so an edited field file
+# is picked up on the next call, and the least recently used maps are evicted
+# beyond maxEntries. The parsed (z, Ez) columns are also kept in a binary
+# sidecar next to the text file ('<name>.npy'), which later runs memory-map
+# instead of parsing the text export again. Returned Ez arrays are shared and
+# read-only.
+
+maxEntries = 8
+cache = OrderedDict()
+digests = {}
+
+def identity(fieldName):
+    path = os.path.abspath(fieldName)
+    return path, os.path.getmtime(path)
+
+def digest(fieldName):
+    # sha1 of the field file contents, remembered per (path, mtime)
+    key = identity(fieldName)
+    if key not in digests:
+        h = hashlib.sha1()
+        with open(key[0], 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digests[key] = h.hexdigest()
+    return digests[key]
+
+def readColumns(path):
+    sidecar = path + '.npy'
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            return np.load(sidecar, mmap_mode='r')
+    except (OSError, IOError, ValueError):
+        pass
+    data = np.loadtxt(path, usecols=(0, 3))
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.rename(tmp, sidecar)
+    except (OSError, IOError):
+        pass
+    return data
+
+def load(fieldName, points=3000):
+    path, mtime = identity(fieldName)
+    key = (path, mtime, points)
+    if key in cache:
+        entry = cache.pop(key)
+        cache[key] = entry
+        return entry
+    for stale in [k for k in cache if k[0] == path and k[1] != mtime]:
+        del cache[stale]
+
+    data = readColumns(path)
+    z = np.linspace(data[0, 0], data[-1, 0], points)
+    Ez = np.interp(z, data[:, 0], data[:, 1])
+    Ez.setflags(write=False)
+    dz = (data[-1, 0] - data[0, 0]) / points
+    entry = (points, dz, Ez)
+    cache[key] = entry
+    while len(cache) > maxEntries:
+        cache.popitem(last=False)
+    return entry
+
+def clear():
+    cache.clear()
+    digests.clear()
@@ -0,0 +1,121 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import fieldmap
+
+# Persistent cache of getTWPhase results.
+#
+# A fit is fully determined by the scan arrays, the getTWPhase arguments and
+# the field map, so the entry key is a sha1 over all of them, with the field
+# map entering through the digest of its contents rather than its name. Each
+# entry is a small JSON file '<key>.json' in the cache directory, written
+# atomically so several refit.py workers can share a directory. Hits touch
+# the file; beyond maxBytes the least recently used entries are removed.
+# Bump version whenever a change to leastsq.py alters the fit results.
+
+version = 2
+
+def plain(value):
+    # numpy values to JSON types
+    if isinstance(value, dict):
+        return dict((k, plain(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return plain(value.tolist())
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class FitCache(object):
+    def __init__(self, root='fitcache', maxBytes=64 << 20):
+        self.root = root
+        self.maxBytes = maxBytes
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+
+    def key(self, cav_phases, bpm_phases, injectEnergy, distance, twissWinPhase, fieldName, step, start_phase, slope, EpeakFactor, **options):
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(cav_phases, dtype=float).tobytes())
+        h.update(b'|')
+        h.update(np.ascontiguousarray(bpm_phases, dtype=float).tobytes())
+        import leastsq
+        args = [version, fieldmap.digest(fieldName), leastsq.defaultIntegrator, leastsq.rk4Tolerance] + [repr(float(v)) for v in (injectEnergy, distance, twissWinPhase, step, start_phase, slope, EpeakFactor)]
+        args += ['%s=%r' % (name, plain(options[name])) for name in sorted(options)]
+        h.update(json.dumps(args).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path, None)
+        except (OSError, IOError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(plain(entry), f)
+            os.rename(tmp, self.path(key))
+        except (OSError, IOError):
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.root):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.root, name))
+
+    def getTWPhase(self, *args, **options):
+        # drop-in for leastsq.getTWPhase
+        full_output = options.pop('full_output', False)
+        key = self.key(*args, **options)
+        entry = self.get(key)
+        if entry is None:
+            from leastsq import getTWPhase
+            result = getTWPhase(*args, full_output=True, **options)
+            entry = dict(result=list(result[:6]), info=result[6])
+            self.put(key, entry)
+        rfPhase, energy_gain, amp, e, x_plot, y_plot = entry['result']
+        result = (rfPhase, energy_gain, amp, e, x_plot, np.asarray(y_plot))
+        if full_output:
+            info = dict(entry['info'])
+            info['p'] = np.asarray(info['p'])
+            info['covariance'] = np.asarray(info['covariance'])
+            result += (info,)
+        return result
@@ -0,0 +1,185 @@
+# Cavity/BPM layout of the linac, shared by the GUI and the headless tools.
+#
+# The layout is read from a JSON file (lattice.json next to this module by
+# default) holding the fit acceptance limits and one record per cavity, in
+# beam order:
+#
+#   {"tolerance": 100, "significance": 0.001, "model_sigma": 0.2,
+#    "cavities": [{"name": "hwr1", "set_pv": ..., "get_pv": ..., "bpm_pv": ...,
+#                  "distance": 0.1026, "field": "Exyz.txt", "synch_phase": -90,
+#                  "slope": 0.95, "epeak_factor": 25, "drift": 0.25}, ...]}
+#
+# drift [m] is the optional length from the end of the cavity's field map to
+# the start of the next one's, through the BPM; without it linac.Linac does
+# not carry the arrival time of the beam past the cavity. The drifts in the
+# shipped lattice.json are nominal and should be checked against the survey.
+#
+# tolerance bounds the residual spread [deg] of an unweighted fit; a fit
+# weighted by the BPM rms is accepted while its chi^2 p-value is at least
+# significance. model_sigma [deg] is the systematic error of the beam model
+# and the phase readback, added in quadrature to the BPM uncertainty of every
+# point (leastsq.bpmSigma): the BPM rms alone can be far below it, and the
+# chi^2 test would then reject good scans. Weighted acceptance is only as
+# good as this value.
+#
+# load() validates the whole file at once and returns a Lattice: the Cavity
+# records plus one numpy column per numeric field for indexed access. With
+# preload=True every referenced field map is also resolved and loaded into
+# the fieldmap cache. configure() makes a Lattice the current one; the
+# module-level lists below are refilled in place, so references taken
+# before (e.g. MyFrame class attributes) stay valid.
+
+import os
+import json
+import numpy as np
+
+defaultPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lattice.json')
+text = (str, type(u''))
+
+class LatticeError(ValueError):
+    pass
+
+class Cavity(object):
+    __slots__ = ('index', 'name', 'set_pv', 'get_pv', 'bpm_pv', 'distance', 'field', 'field_path', 'synch_phase', 'slope', 'epeak_factor', 'drift')
+    fields = (('name', str), ('set_pv', str), ('get_pv', str), ('bpm_pv', str), ('distance', float), ('field', str),
+              ('synch_phase', float), ('slope', float), ('epeak_factor', float))
+    optional = (('drift', float),)
+
+    def __init__(self, index, record, fieldDir):
+        self.index = index
+        for name, kind in self.fields:
+            setattr(self, name, kind(record[name]))
+        self.drift = float(record.get('drift', np.nan))
+        self.field_path = os.path.join(fieldDir, self.field)
+
+    def __repr__(self):
+        return 'Cavity(%r)' % (self.name,)
+
+class Lattice(object):
+    def __init__(self, cavities, tolerance, path=None, significance=0.001, model_sigma=0.2):
+        self.cavities = tuple(cavities)
+        self.tolerance = tolerance
+        self.significance = significance
+        self.model_sigma = model_sigma
+        self.path = path
+        self.names = [cavity.name for cavity in self.cavities]
+        self.distance = np.array([cavity.distance for cavity in self.cavities])
+        self.synch_phase = np.array([cavity.synch_phase for cavity in self.cavities])
+        self.slope = np.array([cavity.slope for cavity in self.cavities])
+        self.epeak_factor = np.array([cavity.epeak_factor for cavity in self.cavities])
+        self.drift = np.array([cavity.drift for cavity in self.cavities])
+
+    def __len__(self):
+        return len(self.cavities)
+
+    def __getitem__(self, index):
+        return self.cavities[index]
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def preload(self):
+        import fieldmap
+        problems = []
+        for path in sorted(set(cavity.field_path for cavity in self.cavities)):
+            try:
+                fieldmap.load(path)
+            except (OSError, IOError, ValueError) as exc:
+                problems.append('%s: %s' % (path, exc))
+        if problems:
+            raise LatticeError('cannot load field maps:\n  ' + '\n  '.join(problems))
+
+def validate(records):
+    problems = []
+    names = set()
+    for index, record in enumerate(records):
+        where = 'cavity %d (%s)' % (index, record.get('name', '?') if isinstance(record, dict) else '?')
+        if not isinstance(record, dict):
+            problems.append('%s: not an object' % where)
+            continue
+        for name, kind in Cavity.fields:
+            if name not in record:
+                problems.append('%s: missing %r' % (where, name))
+            elif kind is float and (isinstance(record[name], bool) or not isinstance(record[name], (int, float))):
+                problems.append('%s: %r must be a number' % (where, name))
+            elif kind is str and (not isinstance(record[name], text) or not record[name]):
+                problems.append('%s: %r must be a non-empty string' % (where, name))
+        for name, kind in Cavity.optional:
+            if name in record and (isinstance(record[name], bool) or not isinstance(record[name], (int, float))):
+                problems.append('%s: %r must be a number' % (where, name))
+        unknown = set(record) - set(name for name, kind in Cavity.fields + Cavity.optional)
+        if unknown:
+            problems.append('%s: unknown keys %s' % (where, ', '.join(sorted(unknown))))
+        if record.get('name') in names:
+            problems.append('%s: duplicate name' % where)
+        names.add(record.get('name'))
+        if isinstance(record.get('distance'), (int, float)) and record['distance'] <= 0:
+            problems.append('%s: distance must be positive' % where)
+        if isinstance(record.get('slope'), (int, float)) and record['slope'] == 0:
+            problems.append('%s: slope must be non-zero' % where)
+        if isinstance(record.get('epeak_factor'), (int, float)) and record['epeak_factor'] <= 0:
+            problems.append('%s: epeak_factor must be positive' % where)
+        if isinstance(record.get('drift'), (int, float)) and isinstance(record.get('distance'), (int, float)) and record['drift'] < record['distance']:
+            problems.append('%s: drift must be at least distance' % where)
+    return problems
+
+def load(path=defaultPath, fieldDir='.', preload=False):
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError as exc:
+            raise LatticeError('%s: %s' % (path, exc))
+    records = data.get('cavities') if isinstance(data, dict) else None
+    if not isinstance(records, list) or not records:
+        raise LatticeError('%s: expected a non-empty "cavities" list' % path)
+    problems = validate(records)
+    tolerance = data.get('tolerance', 100)
+    if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance <= 0:
+        problems.append('tolerance must be a positive number')
+    significance = data.get('significance', 0.001)
+    if isinstance(significance, bool) or not isinstance(significance, (int, float)) or not 0 <= significance < 1:
+        problems.append('significance must be a number in [0, 1)')
+    model_sigma = data.get('model_sigma', 0.2)
+    if isinstance(model_sigma, bool) or not isinstance(model_sigma, (int, float)) or model_sigma < 0:
+        problems.append('model_sigma must be a non-negative number')
+    if problems:
+        raise LatticeError('%s:\n  %s' % (path, '\n  '.join(problems)))
+    config = Lattice([Cavity(index, record, fieldDir) for index, record in enumerate(records)], tolerance, path, significance, model_sigma)
+    if preload:
+        config.preload()
+    return config
+
+cavityList = []
+cavity_set_phase = []
+cavity_get_phase = []
+bpm_pv = []
+distance_cav_bpm = []
+field_names = []
+synch_phases = []
+slopes = []
+TOLERANCE = 100
+SIGNIFICANCE = 0.001
+MODEL_SIGMA = 0.2
+current = None
+
+def configure(path=defaultPath, fieldDir='.', preload=True):
+    global TOLERANCE, SIGNIFICANCE, MODEL_SIGMA, current
+    config = load(path, fieldDir, preload)
+    cavityList[:] = config.names
+    cavity_set_phase[:] = [cavity.set_pv for cavity in config]
+    cavity_get_phase[:] = [cavity.get_pv for cavity in config]
+    bpm_pv[:] = [cavity.bpm_pv for cavity in config]
+    distance_cav_bpm[:] = [cavity.distance for cavity in config]
+    field_names[:] = [cavity.field for cavity in config]
+    synch_phases[:] = [cavity.synch_phase for cavity in config]
+    slopes[:] = [cavity.slope for cavity in config]
+    TOLERANCE = config.tolerance
+    SIGNIFICANCE = config.significance
+    MODEL_SIGMA = config.model_sigma
+    current = config
+    return config
+
+def EpeakFactor(index):
+    return current.epeak_factor[index]
+
+configure(preload=False)
@@ -1,10 +1,9 @@
 import scipy.constants as C
-from scipy import interpolate
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import leastsq
-from pyswarm import pso
+from scipy.optimize import leastsq, least_squares, brentq, fminbound
 import sys
+import hashlib
+import fieldmap
 
 #fieldName = 'Exyz.txt'
 #scanPhaseFile = 'HWR.txt'
@@ -18,91 +17,537 @@ w = 162.5 * 10 ** 6
 #distance = 0.1026
 mass = 938.272
 
-def calTraceWinPhase(Win, c, phase_in, distance, l, dz, Ez):
-    W = Win
-    t = 0
-    a = 0
-    b = 0
-    for i in range(l - 1):
-        gamma = W / mass + 1
-        beta = (1 - gamma**-2)**0.5
-        phi = phase_in + 2 * C.pi * w * (t + 0.5 * dz / ( beta * C.c))
-        W = W +  c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
-        gammaExit = W / mass + 1
-        betaExit = (1 - gammaExit ** -2) ** 0.5
-        a += c * 0.5 * (Ez[i] + Ez[i+1]) * np.sin(phi) * dz
-        b += c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
-        t += dz / (0.5 * (beta + betaExit) * C.c)
+omega = 2 * C.pi * w
+
+# Integrator used by track and trackSensitivities: 'kick' is the original
+# one-kick-per-field-point scheme, 'rk4' integrates (W, t) with classical
+# Runge-Kutta on a per-map step count chosen to reach rk4Tolerance degrees
+# of exit phase (see rk4Steps).
+defaultIntegrator = 'kick'
+rk4Tolerance = 1e-3
+rk4Cache = {}
+
+def setIntegrator(name, tolerance=None):
+    global defaultIntegrator, rk4Tolerance
+    if name not in ('kick', 'rk4'):
+        raise ValueError('unknown integrator %r' % (name,))
+    defaultIntegrator = name
+    if tolerance is not None:
+        rk4Tolerance = tolerance
+
+def beta(W):
+    g = mass / (W + mass)
+    return np.sqrt(1 - g * g)
+
+def rk4Samples(l, dz, Ez, steps):
+    # Ez at the step edges and midpoints of a steps-step RK4 pass
+    key = (fieldKey(l, dz, Ez), steps)
+    if key not in rk4Cache:
+        z = np.arange(2 * steps + 1) * ((l - 1) * dz / (2 * steps))
+        rk4Cache[key] = np.interp(z, np.arange(l) * dz, Ez[:l])
+    return rk4Cache[key]
+
+def fieldKey(l, dz, Ez):
+    return (l, dz, hashlib.sha1(np.ascontiguousarray(Ez[:l])).hexdigest())
+
+def rk4(rhs, state, E, h):
+    state = list(state)
+    for j in range(0, len(E) - 1, 2):
+        k1 = rhs(state, E[j])
+        k2 = rhs([s + 0.5 * h * k for s, k in zip(state, k1)], E[j + 1])
+        k3 = rhs([s + 0.5 * h * k for s, k in zip(state, k2)], E[j + 1])
+        k4 = rhs([s + h * k for s, k in zip(state, k3)], E[j + 2])
+        state = [s + h / 6. * (d1 + 2 * d2 + 2 * d3 + d4) for s, d1, d2, d3, d4 in zip(state, k1, k2, k3, k4)]
+    return state
+
+def rk4Track(Win, c, phase_in, distance, l, dz, Ez, steps):
+    W, c, phase_in = np.broadcast_arrays(np.asarray(Win, dtype=float), np.asarray(c, dtype=float), np.asarray(phase_in, dtype=float))
+    def rhs(state, E):
+        W, t, a = state
+        phi = phase_in + omega * t
+        return c * E * np.cos(phi), 1 / (beta(W) * C.c), c * E * np.sin(phi)
+    zero = np.zeros(W.shape)
+    Wout, t, a = rk4(rhs, (W, zero, zero), rk4Samples(l, dz, Ez, steps), (l - 1) * dz / steps)
+    t = t + distance / (beta(Wout) * C.c)
+    return t[()], a[()], (Wout - W)[()]
+
+def rk4Sensitivities(Win, c, phase_in, distance, l, dz, Ez, steps):
+    # variational equations of (W, t) for c and phase_in, integrated with them
+    W, c, phase_in = np.broadcast_arrays(np.asarray(Win, dtype=float), np.asarray(c, dtype=float), np.asarray(phase_in, dtype=float))
+    def rhs(state, E):
+        W, t, W_c, W_phi, t_c, t_phi = state
+        phi = phase_in + omega * t
+        cos, sin = np.cos(phi), np.sin(phi)
+        b = beta(W)
+        g = mass / (W + mass)
+        dt_dW = -g * g * g / (mass * b ** 3 * C.c)
+        return (c * E * cos, 1 / (b * C.c), E * cos - c * E * sin * omega * t_c, -c * E * sin * (1 + omega * t_phi), dt_dW * W_c, dt_dW * W_phi)
+    zero = np.zeros(W.shape)
+    W, t, W_c, W_phi, t_c, t_phi = rk4(rhs, (W, zero, zero, zero, zero, zero), rk4Samples(l, dz, Ez, steps), (l - 1) * dz / steps)
+    b = beta(W)
+    g = mass / (W + mass)
+    dt_dW = -distance * g * g * g / (mass * b ** 3 * C.c)
+    return (t + distance / (b * C.c))[()], (t_c + dt_dW * W_c)[()], (t_phi + dt_dW * W_phi)[()]
+
+def rk4Steps(Win, l, dz, Ez, tolerance=None):
+    # Per-map (and injection energy) step count: double from 16 steps until
+    # the exit phase of trajectories at c = 1 over all entrance phases moves
+    # by less than tolerance degrees, the Richardson estimate of the error of
+    # the coarser pass.
+    tolerance = rk4Tolerance if tolerance is None else tolerance
+    key = (fieldKey(l, dz, Ez), round(float(np.min(Win)), 2), tolerance)
+    if key not in rk4Cache:
+        phases = np.linspace(-C.pi, C.pi, 8, endpoint=False)
+        steps = 16
+        t = rk4Track(np.min(Win), 1., phases, 0., l, dz, Ez, steps)[0]
+        while steps < 8 * l:
+            finer = rk4Track(np.min(Win), 1., phases, 0., l, dz, Ez, 2 * steps)[0]
+            if np.max(np.abs(finer - t)) * w * 360 < tolerance:
+                break
+            steps, t = 2 * steps, finer
+        rk4Cache[key] = steps
+    return rk4Cache[key]
+
+def track(Win, c, phase_in, distance, l, dz, Ez, midpoint=False, integrator=None):
+    # Advance every broadcast (Win, c, phase_in) combination through the field
+    # map together, one z step at a time, so the Python-level loop runs once per
+    # step instead of once per step and scan point. With midpoint=True the RF
+    # phase is sampled half a step ahead, as calTraceWinPhase does, and the
+    # TraceWin sine sum a is accumulated; b is the energy gain in both modes.
+    # With the rk4 integrator a is always the integral of c * Ez * sin(phi).
+    if (integrator or defaultIntegrator) == 'rk4':
+        return rk4Track(Win, c, phase_in, distance, l, dz, Ez, rk4Steps(Win, l, dz, Ez))
+    W, c, phase_in = np.broadcast_arrays(np.asarray(Win, dtype=float), np.asarray(c, dtype=float), np.asarray(phase_in, dtype=float))
+    W = W.copy()
+    t = np.zeros(W.shape)
+    a = np.zeros(W.shape)
+    b = np.zeros(W.shape)
+    kick = 0.5 * (Ez[:l - 1] + Ez[1:l]) * dz
+    halfStep = 0.5 * dz / C.c
+    stepTime = 2 * dz / C.c
+    beta = (1 - (W / mass + 1) ** -2) ** 0.5
+    betaExit = beta
+    for k in kick:
+        if midpoint:
+            phi = phase_in + omega * (t + halfStep / beta)
+        else:
+            phi = phase_in + omega * t
+        ck = c * k
+        dW = ck * np.cos(phi)
+        W += dW
+        betaExit = (1 - (W / mass + 1) ** -2) ** 0.5
+        b += dW
+        if midpoint:
+            a += ck * np.sin(phi)
+        t += stepTime / (beta + betaExit)
+        beta = betaExit
     t += distance / (betaExit * C.c)
-    traceWin_phi = np.arctan(a / b)
-    if (b < 0 and a < 0):
-        traceWin_phi -= C.pi
-    elif (b < 0 and a > 0):
-        traceWin_phi += C.pi
+    return t[()], a[()], b[()]
 
+def trackSensitivities(Win, c, phase_in, distance, l, dz, Ez, integrator=None):
+    # Same stepping as track (without the midpoint phase), carrying forward-mode
+    # derivatives of W and t with respect to c and phase_in along the way.
+    if (integrator or defaultIntegrator) == 'rk4':
+        return rk4Sensitivities(Win, c, phase_in, distance, l, dz, Ez, rk4Steps(Win, l, dz, Ez))
+    W, c, phase_in = np.broadcast_arrays(np.asarray(Win, dtype=float), np.asarray(c, dtype=float), np.asarray(phase_in, dtype=float))
+    W = W.copy()
+    t = np.zeros(W.shape)
+    dW_dc = np.zeros(W.shape)
+    dW_dphi = np.zeros(W.shape)
+    dt_dc = np.zeros(W.shape)
+    dt_dphi = np.zeros(W.shape)
+    kick = 0.5 * (Ez[:l - 1] + Ez[1:l]) * dz
+    stepTime = 2 * dz / C.c
+    beta = (1 - (W / mass + 1) ** -2) ** 0.5
+    dbeta_dc = np.zeros(W.shape)
+    dbeta_dphi = np.zeros(W.shape)
+    for k in kick:
+        phi = phase_in + omega * t
+        cos = np.cos(phi)
+        cksin = c * k * np.sin(phi)
+        W += c * k * cos
+        dW_dc += k * cos - cksin * omega * dt_dc
+        dW_dphi -= cksin * (1 + omega * dt_dphi)
+        g = mass / (W + mass)
+        betaExit = np.sqrt(1 - g * g)
+        dbeta_dW = g * g * g / (mass * betaExit)
+        dbetaExit_dc = dbeta_dW * dW_dc
+        dbetaExit_dphi = dbeta_dW * dW_dphi
+        s = beta + betaExit
+        dt = stepTime / s
+        t += dt
+        dt_dc -= dt / s * (dbeta_dc + dbetaExit_dc)
+        dt_dphi -= dt / s * (dbeta_dphi + dbetaExit_dphi)
+        beta, dbeta_dc, dbeta_dphi = betaExit, dbetaExit_dc, dbetaExit_dphi
+    t += distance / (beta * C.c)
+    dt_dc -= distance / (beta ** 2 * C.c) * dbeta_dc
+    dt_dphi -= distance / (beta ** 2 * C.c) * dbeta_dphi
+    return t[()], dt_dc[()], dt_dphi[()]
+
+def calTraceWinPhase(Win, c, phase_in, distance, l, dz, Ez):
+    t, a, b = track(Win, c, phase_in, distance, l, dz, Ez, midpoint=True)
+    traceWin_phi = np.arctan2(a, b)
     return traceWin_phi, a, b 
 
-def getEntrPhase(twPhase, Win, f, distance, l, dz, Ez):
-    minimum = 0xffffffff
-    best_fit_phase = -C.pi
+def getEntrPhase(twPhase, Win, f, distance, l, dz, Ez, method='newton', points=24, xtol=1e-7, maxiter=50):
+    # Entrance phase whose TraceWin phase equals twPhase. The wrapped phase
+    # error is bracketed on a coarse grid tracked in one batched pass, then
+    # refined inside the bracket by safeguarded Newton (value and slope from
+    # one two-trajectory pass per iteration) or by Brent's method.
+    # method='grid' keeps the original 1 degree search.
+    if method == 'grid':
+        phis = np.arange(-C.pi, C.pi, C.pi / 180)
+        err = np.abs(calTraceWinPhase(Win, f, phis, distance, l, dz, Ez)[0] - twPhase)
+        return phis[np.argmin(err)]
 
-    for phi in np.arange(-C.pi, C.pi, C.pi / 180):
-        err = abs(calTraceWinPhase(Win, f, phi, distance, l, dz, Ez)[0] - twPhase) 
-        if (err < minimum):
-            minimum = err
-            best_fit_phase = phi
+    def error(phi):
+        return (calTraceWinPhase(Win, f, phi, distance, l, dz, Ez)[0] - twPhase + C.pi) % (2 * C.pi) - C.pi
 
-    return best_fit_phase
+    span = 2 * C.pi / points
+    phis = -C.pi + span * np.arange(points + 1)
+    err = error(phis)
+    # a root is a sign change between small errors; the wrap itself shows up
+    # as a sign change with a jump of about 2 pi
+    brackets = [i for i in range(points) if err[i] * err[i + 1] <= 0 and abs(err[i + 1] - err[i]) < C.pi]
+    if not brackets:
+        # twPhase is not reached exactly: settle for the closest phase
+        i = np.argmin(np.abs(err))
+        phi = fminbound(lambda phi: abs(error(phi)), phis[i] - span, phis[i] + span, xtol=xtol, maxfun=maxiter)
+        return (phi + C.pi) % (2 * C.pi) - C.pi
+    i = min(brackets, key=lambda i: abs(err[i]) + abs(err[i + 1]))
+    lo, hi, errLo, errHi = phis[i], phis[i + 1], err[i], err[i + 1]
+    if errLo == 0:
+        phi = lo
+    elif errHi == 0:
+        phi = hi
+    elif method == 'brent':
+        phi = brentq(error, lo, hi, xtol=xtol, maxiter=maxiter)
+    elif method == 'newton':
+        if errLo > 0:
+            lo, hi, errLo, errHi = hi, lo, errHi, errLo
+        phi = lo - errLo * (hi - lo) / (errHi - errLo)
+        h = 1e-6
+        for it in range(maxiter):
+            e, eh = error(np.array([phi, phi + h]))
+            if e < 0:
+                lo = phi
+            else:
+                hi = phi
+            step = e * h / (eh - e) if eh != e else np.inf
+            new = phi - step
+            if not min(lo, hi) < new < max(lo, hi):
+                new = 0.5 * (lo + hi)
+            if abs(new - phi) < xtol:
+                phi = new
+                break
+            phi = new
+    else:
+        raise ValueError('unknown entrance phase method %r' % (method,))
+    return (phi + C.pi) % (2 * C.pi) - C.pi
 
 def energyGain(Win, c, phase_in, distance, l, dz, Ez):
-    W = Win
-    t = 0
-    a = 0
-    b = 0
-    for i in range(l - 1):
-        phi = phase_in + 2 * C.pi * w * t
-        gamma = W / mass + 1
-        beta = (1 - gamma**-2)**0.5
-        W = W +  c * 0.5 * (Ez[i] + Ez[i+1]) * np.cos(phi) * dz
-        gammaExit = W / mass + 1
-        betaExit = (1 - gammaExit ** -2) ** 0.5
-        #a += c * Ez[i] * sin(phi) * dz
-        #b += c * Ez[i] * cos(phi) * dz
-        t += dz / (0.5 * (beta + betaExit) * C.c)
-    t += distance / (betaExit * C.c)
-    #traceWin_phi = actan(a / b)
+    t = track(Win, c, phase_in, distance, l, dz, Ez)[0]
     return -(w * t) * 180 * 2
 
+def weights(sigma):
+    # 1/sigma per point; zero sigmas (e.g. a constant BPM reading) are raised
+    # to a tenth of the median, missing ones get the largest sigma of the scan
+    sigma = np.asarray(sigma, dtype=float)
+    good = np.isfinite(sigma) & (sigma > 0)
+    if not good.any():
+        raise ValueError('no usable sigma')
+    floor = 0.1 * np.median(sigma[good])
+    sigma = np.where(np.isfinite(sigma), np.maximum(sigma, floor), sigma[good].max())
+    return 1 / sigma
+
+def bpmSigma(rms, num_read, floor=0.):
+    # uncertainty [deg] of BPM phases averaged over num_read readings, from
+    # their rms (ddof=0); the rms of a handful of readings scatters a lot, so
+    # each point's variance is averaged with the mean variance of the scan.
+    # floor, the systematic error of the model (lattice.MODEL_SIGMA), is added
+    # in quadrature. None when no point has a usable rms.
+    var = np.asarray(rms, dtype=float) ** 2
+    good = np.isfinite(var) & (var > 0)
+    if not good.any():
+        return None
+    var = 0.5 * (np.where(good, var, var[good].mean()) + var[good].mean())
+    return np.sqrt(var / max(num_read - 1, 1) + floor ** 2)
+
+class ScanModel(object):
+    # residuals and jacobian for one scan, sharing a single sensitivity pass:
+    # MINPACK asks for the Jacobian at the point whose residuals it has just
+    # evaluated, so the second request is served from the cached tracking.
+    # Given per-point sigma [deg], residuals and jacobian are divided by it,
+    # so the fits minimise chi^2.
+    def __init__(self, y, injectEnergy, distance, l, dz, Ez, x, table=None, sigma=None):
+        self.y = np.asarray(y, dtype=float)
+        self.args = (injectEnergy, distance, l, dz, Ez)
+        self.x = x
+        self.table = table
+        self.weight = None if sigma is None else weights(sigma)
+        self.p = None
+
+    def batch(self, p, y=None):
+        # residuals (..., n) and jacobian (..., n, 3) for a batch of
+        # parameter vectors (..., 3), against the scans y (..., n)
+        injectEnergy, distance, l, dz, Ez = self.args
+        p = np.asarray(p, dtype=float)
+        y = self.y if y is None else y
+        if self.table is None:
+            t, dt_dc, dt_dphi = trackSensitivities(injectEnergy, p[..., 0, None], p[..., 1, None] + self.x, distance, l, dz, Ez)
+        else:
+            t, dt_dc, dt_dphi = self.table.timeSensitivities(injectEnergy, p[..., 0, None], p[..., 1, None] + self.x, distance)
+        err = y - (-(w * t) * 180 * 2 + p[..., 2, None])
+        jac = np.stack(np.broadcast_arrays(w * 360 * dt_dc, w * 360 * dt_dphi, -1.), axis=-1)
+        if self.weight is not None:
+            err = err * self.weight
+            jac = jac * self.weight[:, None]
+        return err, jac
+
+    def evaluate(self, p):
+        p = np.array(p, dtype=float)
+        if self.p is None or not np.array_equal(p, self.p):
+            self.err, self.jac = self.batch(p)
+            self.p = p
+        return self.err, self.jac
+
+    def profile(self, c, phase_in):
+        # sum of squared (weighted) residuals for a batch of (c, phase_in)
+        # with the BPM offset profiled out, tracking the whole batch in one
+        # call
+        injectEnergy, distance, l, dz, Ez = self.args
+        c = np.asarray(c, dtype=float)[..., None]
+        phase_in = np.asarray(phase_in, dtype=float)[..., None] + self.x
+        if self.table is None:
+            t = track(injectEnergy, c, phase_in, distance, l, dz, Ez)[0]
+        else:
+            t = self.table.timeSensitivities(injectEnergy, c, phase_in, distance)[0]
+        r = self.y - (-(w * t) * 180 * 2)
+        if self.weight is None:
+            offset = r.mean(axis=-1)
+            return ((r - offset[..., None]) ** 2).sum(axis=-1), offset
+        w2 = self.weight ** 2
+        offset = (r * w2).sum(axis=-1) / w2.sum()
+        return ((r - offset[..., None]) ** 2 * w2).sum(axis=-1), offset
+
+    def covariance(self, p):
+        # covariance of (c, phase_in, offset) at the fit p, with chi^2 and
+        # its degrees of freedom; without sigmas the residual spread stands
+        # in for them and chi^2 is None
+        err, jac = self.evaluate(p)
+        dof = len(err) - 3
+        chi2 = float((err ** 2).sum())
+        cov = np.linalg.pinv(jac.T.dot(jac))
+        if self.weight is None:
+            cov = cov * (chi2 / dof if dof > 0 else np.inf)
+            chi2 = None
+        return cov, chi2, dof
+
+    def residuals(self, p):
+        return self.evaluate(p)[0]
+
+    def jacobian(self, p):
+        return self.evaluate(p)[1]
+
 def residuals(p, y, injectEnergy, distance, l, dz, Ez, x):
-    c, phase_in, offset = p
-    err =  np.array(y) - [energyGain(injectEnergy, c, phase_in + e, distance, l, dz, Ez) + offset for e in x]
-    return err
-
-def getTWPhase(cav_phases, bpm_phases, injectEnergy, distance, twissWinPhase, fieldName, step, start_phase, slope, EpeakFactor):
-    data = np.loadtxt(fieldName)
-    z = np.linspace(data[0, 0], data[-1, 0], 3000)
-    f = interpolate.interp1d(data[:, 0], data[:, 3], kind='slinear')
-    Ez = f(z)
-    l = len(z)
-    dz = (data[-1, 0] - data[0, 0]) / 3000
+    # the original one-scan residuals, kept for scripts calling them; the
+    # fits use ScanModel
+    return ScanModel(y, injectEnergy, distance, l, dz, Ez, np.asarray(x, dtype=float)).residuals(p)
+
+def globalFit(model, bounds=((0, 2), (-C.pi, C.pi)), swarmsize=24, maxiter=40, starts=4, stall=4, minfunc=1e-3, seed=0, coarse=None):
+    # Particle swarm over (c, phase_in) with the offset profiled out, the
+    # whole swarm tracked as one batch per iteration, then leastsq refinement
+    # from the best distinct particles. The swarm runs on the coarse model
+    # (e.g. the TTF surrogate of the same scan) when one is given. Returns
+    # popt and a dict of convergence diagnostics.
+    swarm = model if coarse is None else coarse
+    rs = np.random.RandomState(seed)
+    lb, ub = np.array(bounds, dtype=float).T
+    span = ub - lb
+    pos = lb + rs.uniform(size=(swarmsize, 2)) * span
+    vel = rs.uniform(-1, 1, size=(swarmsize, 2)) * span
+    cost = swarm.profile(pos[:, 0], pos[:, 1])[0]
+    best_pos, best_cost = pos.copy(), cost.copy()
+    g = np.argmin(best_cost)
+    history = [best_cost[g]]
+    iterations = still = 0
+    while iterations < maxiter and still < stall:
+        iterations += 1
+        rp, rg = rs.uniform(size=(2, swarmsize, 2))
+        vel = 0.5 * vel + 0.5 * rp * (best_pos - pos) + 0.5 * rg * (best_pos[g] - pos)
+        pos = pos + vel
+        # c is clipped to its bounds, the phase is periodic
+        pos[:, 0] = np.clip(pos[:, 0], lb[0], ub[0])
+        pos[:, 1] = lb[1] + (pos[:, 1] - lb[1]) % span[1]
+        cost = swarm.profile(pos[:, 0], pos[:, 1])[0]
+        better = cost < best_cost
+        best_pos[better], best_cost[better] = pos[better], cost[better]
+        g = np.argmin(best_cost)
+        history.append(best_cost[g])
+        still = still + 1 if history[-2] - history[-1] <= minfunc * max(history[-2], 1e-12) else 0
+
+    # refine from up to `starts` personal bests that are not the same minimum
+    seeds = []
+    for k in np.argsort(best_cost):
+        c, phase = best_pos[k]
+        if all(abs(c - s[0]) > 0.05 * span[0] or abs((phase - s[1] + C.pi) % (2 * C.pi) - C.pi) > 0.2 for s in seeds):
+            seeds.append((c, phase))
+        if len(seeds) == starts:
+            break
+    minima = []
+    for c, phase in seeds:
+        offset = model.profile(c, phase)[1][()]
+        p = leastsq(model.residuals, [c, phase, offset], Dfun=model.jacobian)[0]
+        minima.append((float((model.residuals(p) ** 2).sum()), p))
+    minima.sort(key=lambda m: m[0])
+    popt = minima[0][1]
+    n = len(model.x)
+    info = dict(method='global', iterations=iterations, evaluations=swarmsize * (iterations + 1), converged=still >= stall,
+                swarm_cost=history[-1], cost=minima[0][0], error=np.sqrt(minima[0][0] / n), history=history,
+                minima=[(cost, list(p)) for cost, p in minima],
+                # a distinct minimum within 10% of the best cost means the
+                # scan does not pin the parameters down
+                ambiguous=any(cost <= 1.1 * minima[0][0] and (abs(p[0] - popt[0]) > 0.05 * span[0] or abs((p[1] - popt[1] + C.pi) % (2 * C.pi) - C.pi) > 0.2) for cost, p in minima[1:]))
+    return popt, info
+
+def bootstrapFit(model, popt, samples=200, seed=0, maxiter=5, xtol=1e-5):
+    # Residual bootstrap: `samples` scans made of the fitted curve plus the
+    # resampled (weighted) residuals are refitted together, each by
+    # Gauss-Newton from popt with the whole set tracked as one batch per
+    # iteration. Returns the (samples, 3) refitted parameters.
+    rs = np.random.RandomState(seed)
+    err = model.residuals(popt)
+    n = len(err)
+    sigma = 1. if model.weight is None else 1 / model.weight
+    # residuals shrink by sqrt((n - 3) / n) in the fit, undo it
+    resampled = err[rs.randint(n, size=(samples, n))] * np.sqrt(n / max(n - 3., 1.))
+    y = model.y - err * sigma + resampled * sigma
+    p = np.tile(np.asarray(popt, dtype=float), (samples, 1))
+    for it in range(maxiter):
+        r, jac = model.batch(p, y)
+        step = -np.einsum('bij,bj->bi', np.linalg.pinv(jac), r)
+        p += step
+        if np.max(np.abs(step)) < xtol:
+            break
+    return p
+
+def fitScan(x, bpm_phases, injectEnergy, distance, l, dz, Ez, p0=(1, 0, 0), method='leastsq', bounds=None, table=None, full_output=False, coarse=None, sigma=None):
+    # method='least_squares' uses scipy's trust-region solver; by default c is
+    # kept positive there, which removes the (c, phase_in + pi) twin minimum.
+    # method='global' runs globalFit, bounds being the (c, phase_in) box of the
+    # swarm, and a ttf.TTFTable passed as coarse speeds up its swarm stage.
+    # Passing a ttf.TTFTable as table fits the transit-time-factor surrogate
+    # instead of tracking through the field map. sigma [deg] per point makes
+    # it a weighted (chi^2) fit. full_output adds a dict of diagnostics.
+    model = ScanModel(bpm_phases, injectEnergy, distance, l, dz, Ez, x, table, sigma)
+    if method == 'leastsq':
+        popt = leastsq(model.residuals, p0, Dfun=model.jacobian)[0]
+    elif method == 'least_squares':
+        if bounds is None:
+            bounds = ([0, -np.inf, -np.inf], np.inf)
+        p0 = np.clip(p0, bounds[0], bounds[1])
+        popt = least_squares(model.residuals, p0, jac=model.jacobian, bounds=bounds, method='trf').x
+    elif method == 'global':
+        if coarse is not None and coarse.covers(injectEnergy):
+            coarse = ScanModel(bpm_phases, injectEnergy, distance, l, dz, Ez, x, coarse, sigma)
+        else:
+            coarse = None
+        if bounds is None:
+            popt, info = globalFit(model, coarse=coarse)
+        else:
+            popt, info = globalFit(model, bounds, coarse=coarse)
+    else:
+        raise ValueError('unknown fit method %r' % (method,))
+    if not full_output:
+        return popt
+    if method != 'global':
+        cost = float((model.residuals(popt) ** 2).sum())
+        info = dict(method=method, cost=cost, error=np.sqrt(cost / len(x)))
+    return popt, info
+
+def getTWPhase(cav_phases, bpm_phases, injectEnergy, distance, twissWinPhase, fieldName, step, start_phase, slope, EpeakFactor, method='leastsq', bounds=None, surrogate=False, surrogate_tolerance=0.1, uniform=True, full_output=False,
+               sigma=None, bootstrap=0):
+    # sigma: per-point BPM phase uncertainty [deg] for a weighted fit
+    # full_output appends a dict with the fitted model, the covariance of
+    # (c, phase_in, offset) and the resulting 1-sigma of rfPhase and of the
+    # exit energy, chi^2 with its p-value when sigma is given, and with
+    # bootstrap=N the spread of N batched bootstrap refits.
+    l, dz, Ez = fieldmap.load(fieldName)
     fitStep = step * slope
     fitPointNum = len(cav_phases)
 
-    x = -np.arange(fitPointNum) * fitStep
+    if uniform:
+        x = -np.arange(fitPointNum) * fitStep
+    else:
+        # cav_phases [deg] in any order and spacing, e.g. an adaptive scan
+        x = -(np.asarray(cav_phases, dtype=float) - start_phase) * C.pi / 180 * slope
     p0 = [1, 0, 0]
-    plsq = leastsq(residuals, p0, args=(bpm_phases, injectEnergy, distance, l, dz, Ez, x))
-    error = np.std(residuals(plsq[0], bpm_phases, injectEnergy, distance, l, dz, Ez, x))
+    table = None
+    if surrogate:
+        import ttf
+        table = ttf.getTable(fieldName, l, dz, Ez)
+        if table.covers(injectEnergy):
+            p0, diagnostics = fitScan(x, bpm_phases, injectEnergy, distance, l, dz, Ez, p0, method, bounds, table, full_output=True, sigma=sigma)
+            # keep the surrogate only if it reproduces the full tracker to
+            # within surrogate_tolerance degrees over this scan
+            if table.deviation(injectEnergy, p0, x, distance, l, dz, Ez) <= surrogate_tolerance:
+                popt = p0
+            else:
+                table = None
+        else:
+            table = None
+    if table is None:
+        coarse = None
+        if method == 'global':
+            # the swarm only has to find the basin, the surrogate is plenty
+            import ttf
+            coarse = ttf.getTable(fieldName, l, dz, Ez)
+        popt, diagnostics = fitScan(x, bpm_phases, injectEnergy, distance, l, dz, Ez, p0, method, bounds, full_output=True, coarse=coarse, sigma=sigma)
 
     twissWinPhase = twissWinPhase * C.pi / 180
-    scaleFactor = plsq[0][0]
-    xopt = getEntrPhase(twissWinPhase, injectEnergy, scaleFactor, distance, l, dz, Ez)
+    def design(c):
+        # entrance phase giving the TraceWin phase, and the energy gain there
+        if table is None:
+            xopt = getEntrPhase(twissWinPhase, injectEnergy, c, distance, l, dz, Ez)
+            return xopt, calTraceWinPhase(injectEnergy, c, xopt, distance, l, dz, Ez)[2]
+        xopt = table.getEntrPhase(twissWinPhase, injectEnergy, c)
+        return xopt, table.calTraceWinPhase(injectEnergy, c, xopt)[2]
 
-    y = [energyGain(injectEnergy, plsq[0][0], plsq[0][1] + e, distance, l, dz, Ez) for e in x]
+    xopt, exit_energy = design(popt[0])
+    if table is None:
+        y = energyGain(injectEnergy, popt[0], popt[1] + x, distance, l, dz, Ez)
+    else:
+        y = table.energyGain(injectEnergy, popt[0], popt[1] + x, distance)
+    error = np.std(np.asarray(bpm_phases) - (y + popt[2]))
 
-    rfPhase = (plsq[0][1] - xopt) * 180 / C.pi / slope + start_phase
-    exit_energy = calTraceWinPhase(injectEnergy, plsq[0][0], xopt, distance, l, dz, Ez)[2]
+    rfPhase = (popt[1] - xopt) * 180 / C.pi / slope + start_phase
     rfPhase = phaseWrappingFunction(rfPhase, slope)
-    return rfPhase, exit_energy, plsq[0][0] * EpeakFactor, error, cav_phases, y + plsq[0][2]
+    if full_output:
+        # the fitted model, e.g. to calibrate a linac.Linac
+        info = dict(p=popt, start_phase=start_phase, entrance_phase=xopt, surrogate=table is not None, diagnostics=diagnostics)
+        model = ScanModel(bpm_phases, injectEnergy, distance, l, dz, Ez, x, table, sigma)
+        cov, chi2, dof = model.covariance(popt)
+        # rfPhase and the exit energy depend on c through the entrance phase,
+        # linearised by a central difference
+        h = 1e-4 * max(abs(popt[0]), 1e-2)
+        (xLo, energyLo), (xHi, energyHi) = design(popt[0] - h), design(popt[0] + h)
+        dxopt_dc = ((xHi - xLo + C.pi) % (2 * C.pi) - C.pi) / (2 * h)
+        grad = np.array([[-dxopt_dc * 180 / C.pi / slope, 180 / C.pi / slope, 0.], [(energyHi - energyLo) / (2 * h), 0., 0.]])
+        spread = np.sqrt(np.maximum(np.einsum('ij,jk,ik->i', grad, cov, grad), 0))
+        p_value = None
+        if chi2 is not None and dof > 0:
+            # scipy.stats is slow to import, only weighted fits need it
+            from scipy.stats import chi2 as chi2dist
+            p_value = float(chi2dist.sf(chi2, dof))
+        info.update(covariance=cov, sigma_rfPhase=spread[0], sigma_energy=spread[1], chi2=chi2, dof=dof, p_value=p_value)
+        if bootstrap:
+            p = bootstrapFit(model, popt, bootstrap)
+            delta = p - popt
+            delta[:, 1] = (delta[:, 1] + C.pi) % (2 * C.pi) - C.pi
+            spread = np.std(delta.dot(grad.T), axis=0)
+            info['bootstrap'] = dict(samples=bootstrap, sigma_p=np.std(delta, axis=0), sigma_rfPhase=spread[0], sigma_energy=spread[1])
+        return rfPhase, exit_energy, popt[0] * EpeakFactor, error, cav_phases, y + popt[2], info
+    return rfPhase, exit_energy, popt[0] * EpeakFactor, error, cav_phases, y + popt[2]
 
 def phaseWrappingFunction(inValue, slope):
     outValue = inValue
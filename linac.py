@@ -0,0 +1,190 @@
+import os
+import json
+import math
+from collections import OrderedDict
+import numpy as np
+import scipy.constants as C
+import lattice
+import fieldmap
+import leastsq
+
+# Longitudinal model of the whole cavity sequence.
+#
+# Each cavity is described by its field map, cavity-BPM distance, drift to
+# the next cavity and slope from the lattice configuration, plus the
+# (c, phase_in, offset) of its last phase-scan fit taken at start_phase. A
+# cavity setpoint s maps to the model entrance phase
+# phase_in - (s - start_phase) * slope, exactly as in the fit, so the model
+# predicts every BPM phase and energy for any set of setpoints.
+# Uncalibrated cavities are treated as off (c = 0).
+#
+# A fit only knows the beam as it arrived during that scan, with the
+# upstream cavities at the setpoints they were held at (their reference,
+# given to calibrate()). track() therefore carries a reference beam along
+# with the beam: both are timed from the entrance of the first tracked
+# cavity through every cavity and drift, and the difference of their arrival
+# times at a cavity shifts its entrance phase and its BPM phase. Timing stops
+# at a cavity without a drift, and a cavity without a reference counts as
+# held where it is set.
+#
+# track() accepts a batch of setpoint vectors and tracks the whole batch
+# through each cavity in one pass. For single (non-batched) queries the
+# state in front of every cavity is cached, so predictions that only change
+# downstream setpoints reuse the upstream tracking; the least recently used
+# prefixes are evicted beyond maxEntries.
+#
+# By default the cavities are tracked through their field maps like the fit,
+# so predictions carry no model error of their own. That is slow: a full
+# prediction through the 14 cavities of lattice.json takes about 0.5 s, and
+# only changing the last cavity about 40 ms. predict() is the fast path, a
+# few ms: it tracks with the transit-time-factor tables of ttf.py where they
+# cover the energy. The surrogate is first order in c (see ttf.py), so each
+# cavity gains a few keV too much or too little at c = 0.5, and over the
+# drifts that becomes a timing error: against track(), the BPM right behind
+# a changed cavity is within 0.3 degree, the last BPM of lattice.json within
+# about 1 degree at c = 0.1 but only 20 degrees at c = 0.25 and 50 degrees at
+# c = 0.5. Use it to look for setpoints, and track() to check them.
+
+maxEntries = 256
+
+class Linac(object):
+    def __init__(self, fieldDir='.', surrogate=False):
+        config = lattice.current
+        n = len(config)
+        self.names = list(config.names)
+        self.field_names = [os.path.join(fieldDir, cavity.field) for cavity in config]
+        self.distance = config.distance.copy()
+        self.drift = config.drift.copy()
+        self.slope = config.slope.copy()
+        self.synch_phase = config.synch_phase.copy()
+        self.c = np.zeros(n)
+        self.phase_in = np.zeros(n)
+        self.offset = np.zeros(n)
+        self.start_phase = np.zeros(n)
+        self.reference = np.full(n, np.nan)
+        self.calibrated = np.zeros(n, dtype=bool)
+        self.surrogate = surrogate
+        self.cache = OrderedDict()
+
+    def calibrate(self, index, p, start_phase, reference=None):
+        # reference: setpoint the cavity is held at while the cavities behind
+        # it are scanned, None if unknown
+        self.c[index], self.phase_in[index], self.offset[index] = p
+        self.start_phase[index] = start_phase
+        self.reference[index] = np.nan if reference is None else reference
+        self.calibrated[index] = True
+        self.cache.clear()
+
+    def model_phase(self, index, setpoint):
+        return self.phase_in[index] - (np.asarray(setpoint, dtype=float) - self.start_phase[index]) * math.pi / 180 * self.slope[index]
+
+    def cavity(self, index, Win, phase, surrogate=None):
+        # energy gain and time of flight [s] to the BPM through one cavity,
+        # batched over Win and the model entrance phase
+        l, dz, Ez = fieldmap.load(self.field_names[index])
+        table = None
+        if self.surrogate if surrogate is None else surrogate:
+            import ttf
+            table = ttf.getTable(self.field_names[index], l, dz, Ez)
+        if table is not None and table.covers(np.min(Win)) and table.covers(np.max(Win)):
+            t = table.timeSensitivities(Win, self.c[index], phase, self.distance[index])[0]
+            gain = table.calTraceWinPhase(Win, self.c[index], phase)[2]
+        else:
+            t, a, gain = leastsq.track(Win, self.c[index], phase, self.distance[index], l, dz, Ez)
+        return gain, t
+
+    def advance(self, index, W, T, setpoint, surrogate=None):
+        # the beam (row 0 of W and T) and the reference beam (row 1) from the
+        # entrance of cavity index to the entrance of the next one; W, T are
+        # their energies and arrival times. Returns W, T there and the BPM
+        # phase of the beam.
+        reference = setpoint if np.isnan(self.reference[index]) else self.reference[index]
+        delay = T[0] - T[1]
+        phase = np.array(np.broadcast_arrays(self.model_phase(index, setpoint) + leastsq.omega * delay, self.model_phase(index, reference)))
+        gain, t = self.cavity(index, W, phase, surrogate)
+        bpm = -(leastsq.w * (t[0] + delay)) * 180 * 2 + self.offset[index]
+        W = W + gain
+        if np.isnan(self.drift[index]):
+            T = np.zeros(W.shape)
+        else:
+            T = T + t + (self.drift[index] - self.distance[index]) / (leastsq.beta(W) * C.c)
+        return W, T, bpm
+
+    def track(self, Win, setpoints, first=0, surrogate=None):
+        # setpoints [deg] of cavities first, first + 1, ... along the last
+        # axis, any leading axes are a batch; returns the energies in front
+        # of and behind every cavity (one more than setpoints) and the BPM
+        # phases. surrogate overrides the one given to the constructor.
+        setpoints = np.asarray(setpoints, dtype=float)
+        surrogate = self.surrogate if surrogate is None else surrogate
+        m = setpoints.shape[-1]
+        batch = setpoints.shape[:-1]
+        energies = np.empty(batch + (m + 1,))
+        bpm = np.empty(batch + (m,))
+        energies[..., 0] = Win
+        W = np.empty((2,) + np.broadcast(np.empty(batch), np.asarray(Win)).shape)
+        W[:] = Win
+        T = np.zeros(W.shape)
+        start = 0
+        cached = not batch and np.ndim(Win) == 0
+        if cached:
+            for k in range(m, 0, -1):
+                key = (first, float(Win), surrogate, tuple(setpoints[:k]))
+                if key in self.cache:
+                    entry = self.cache.pop(key)
+                    self.cache[key] = entry
+                    energies[:k + 1], bpm[:k], W, T = entry
+                    start = k
+                    break
+        for k in range(start, m):
+            W, T, bpm[..., k] = self.advance(first + k, W, T, setpoints[..., k], surrogate)
+            energies[..., k + 1] = W[0]
+            if cached:
+                self.cache[(first, float(Win), surrogate, tuple(setpoints[:k + 1]))] = (energies[:k + 2].copy(), bpm[:k + 1].copy(), W, T)
+                while len(self.cache) > maxEntries:
+                    self.cache.popitem(last=False)
+        return energies, bpm
+
+    def predict(self, Win, setpoints, first=0):
+        # track() with the surrogate, for interactive predictions
+        return self.track(Win, setpoints, first, surrogate=True)
+
+    def design_setpoints(self, Win, first=0, last=None):
+        # setpoints putting each calibrated cavity at its synchronous phase,
+        # chaining the energy as the scan does and the arrival time as track()
+        # does; returns setpoints and energies
+        last = len(self.names) - 1 if last is None else last
+        setpoints = []
+        energies = [Win]
+        W = np.array([Win, Win], dtype=float)
+        T = np.zeros(2)
+        for index in range(first, last + 1):
+            l, dz, Ez = fieldmap.load(self.field_names[index])
+            if not self.calibrated[index]:
+                setpoints.append(np.nan)
+                energies.append(energies[-1])
+                W, T = self.advance(index, W, T, self.start_phase[index])[:2]
+                continue
+            xopt = leastsq.getEntrPhase(self.synch_phase[index] * math.pi / 180, energies[-1], self.c[index], self.distance[index], l, dz, Ez)
+            rfPhase = (self.phase_in[index] - xopt + leastsq.omega * (T[0] - T[1])) * 180 / math.pi / self.slope[index] + self.start_phase[index]
+            setpoints.append(leastsq.phaseWrappingFunction(rfPhase, self.slope[index]))
+            energies.append(energies[-1] + leastsq.calTraceWinPhase(energies[-1], self.c[index], xopt, self.distance[index], l, dz, Ez)[2])
+            W, T = self.advance(index, W, T, rfPhase)[:2]
+            W[0] = energies[-1]
+        return np.array(setpoints), np.array(energies)
+
+    def save(self, filename):
+        f = open(filename, 'w')
+        json.dump(dict(names=self.names, c=list(self.c), phase_in=list(self.phase_in), offset=list(self.offset),
+                       start_phase=list(self.start_phase), reference=[None if np.isnan(v) else v for v in self.reference],
+                       calibrated=[bool(v) for v in self.calibrated]), f, indent=1)
+        f.close()
+
+    def load(self, filename):
+        f = open(filename)
+        data = json.load(f)
+        f.close()
+        for index, name in enumerate(data['names']):
+            if name in self.names and data['calibrated'][index]:
+                reference = data['reference'][index] if 'reference' in data else None
+                self.calibrate(self.names.index(name), (data['c'][index], data['phase_in'][index], data['offset'][index]), data['start_phase'][index], reference)
@@ -1,108 +1,50 @@
 # -*- coding: utf-8 -*- 
 
+import time
+started = time.time()
 import wx
 import numpy as np
-import time
 import os
 import threading
-from epics import PV
 from epics.ca import CAThread, create_context, destroy_context
-import matplotlib
-from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas  
-from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar  
-from matplotlib.ticker import MultipleLocator, FuncFormatter
-from matplotlib.figure import Figure
-import scipy.constants as C
-
-import pylab  
-from matplotlib import pyplot 
-from leastsq import getTWPhase
+from fitcache import FitCache
+from scanner import ScanEngine, ScanObserver
+from telemetry import Telemetry
+import lattice
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
-class WorkThread(CAThread):
-    def __init__(self, window, Win, first_cavity_id, last_cavity_id, first_phase, last_phase, phase_step, delay_before_scan, delay_read, num_read, mode): 
-        CAThread.__init__(self)
+# Startup is kept short: the fit code (leastsq, scipy) is imported by
+# ScanEngine and FitCache on the first fit, and the matplotlib canvas, the
+# slowest part of the window, is built by MyFrame.build_plot once the frame
+# is already on screen. Both steps are recorded in the telemetry log
+# ('startup', 'startup_plot'); bench.py --startup checks the import times.
+
+class FrameObserver(ScanObserver):
+    # forwards ScanEngine progress to the wx frame on the GUI thread
+    def __init__(self, window, mode):
         self.window = window
-        self.Win = Win
-        self.first_cavity_id = first_cavity_id
-        self.last_cavity_id = last_cavity_id
-        self.first_phase = first_phase
-        self.last_phase = last_phase
-        self.phase_step = phase_step
-        self.delay_before_scan = delay_before_scan
-        self.delay_read = delay_read
-        self.num_read = num_read
-
-        self.timeToQuit = threading.Event()
-        self.timeToPause = threading.Event()
-        self.timeToQuit.clear()
-        self.timeToPause.clear()
-        self.pause = False
         self.mode = mode
 
-    def scan(self, index, cavity_pv, cavity_pv_readback):
-        x = []
-        y = []
-        std_errors = []
-       
-        f = open('%s.%s' % (self.window.cavityList[index], 'txt'), 'w')
-        wx.CallAfter(self.window.slider.SetRange, 0, self.last_phase - self.first_phase)
-        self.cavity_pv = PV(cavity_pv)
-        self.bpm_pv = PV(self.window.bpm_pv[index])
-        self.cav_readback = PV(cavity_pv_readback)
-
-        first_phase = self.first_phase
-
-        while ((self.last_phase - first_phase) * self.phase_step > 0):
-            if self.timeToQuit.isSet(): 
-                break
-            if self.pause:
-                self.timeToPause.wait()
-
-            wx.CallAfter(self.window.slider.SetValue, first_phase - self.first_phase)
-            if self.window.cavityList[index].startswith("buncher"):
-                while True:
-                    self.cavity_pv.put(first_phase)
-                    time.sleep(1)
-                    if self.cav_readback.get() and abs(int(self.cav_readback.get()) - int(first_phase)) < 5:
-                        break
-            else:
-                for i in range(3):
-                    self.cavity_pv.put(first_phase)
-                    time.sleep(1)
-
-            bpm_phases = []
-            for i in range(self.num_read):
-                bpm_phase = self.bpm_pv.get()
-                bpm_phases.append(bpm_phase)
-                self.timeToQuit.wait(self.delay_read)
-
-            average = np.mean(bpm_phases)
-            rms = np.std(bpm_phases)
-            f.write('%s\t' % first_phase)
-            f.write('%s\t' % average)
-            f.write('%s\n' % rms)
-
-            x.append(first_phase)
-            y.append(average)
-            std_errors.append(rms)
-            wx.CallAfter(self.window.updateGraph, self.window.scan_line, x, y)
-            first_phase += self.phase_step
-
-        f.close()
-        return x, y, std_errors
-
-    def fit(self, distance, twPhase, fieldName, step, slope, x, y, EpeakFactor):
-        
-        rfPhase, energy_gain, amp, e, x_plot, y_plot = getTWPhase(x, y, self.Win, distance, twPhase, fieldName, step, self.first_phase, slope, EpeakFactor)
-        return rfPhase, energy_gain, amp, e, x_plot, y_plot
+    def scan_started(self, index, first_phase, last_phase):
+        self.first_phase = first_phase
+        wx.CallAfter(self.window.slider.SetRange, 0, last_phase - first_phase)
 
-    def prepare_for_next(self, rfPhase, energy_gain, amp, x_plot, y_plot):
-        self.Win += energy_gain
-        #self.cavity_pv.put(rfPhase)
-        wx.CallAfter(self.window.display_frame.write_line, '%s\t%s\t%s' % (rfPhase, self.Win, amp))
-        wx.CallAfter(self.window.updateGraph, self.window.fit_line, x_plot, y_plot)
+    def phase_set(self, index, phase):
+        wx.CallAfter(self.window.slider.SetValue, phase - self.first_phase)
+
+    def point_measured(self, index, x, y, errors):
+        self.window.post_graph(self.window.scan_line, x, y)
+
+    def cavity_fitted(self, index, rfPhase, Win, amp, x_plot, y_plot):
+        wx.CallAfter(self.window.display_frame.write_line, '%s\t%s\t%s' % (rfPhase, Win, amp))
+        self.window.post_graph(self.window.fit_line, x_plot, y_plot)
+
+    def cavity_done(self, index, scan):
+        if self.mode == 1:
+            wx.CallAfter(self.window.clear_graph)
+        else:
+            self.data_save(**scan)
 
     def data_save(self, x, y, errors, distance, twPhase, fieldName, step, slope, EpeakFactor):
         self.window.data_changed = True
@@ -116,45 +58,49 @@ class WorkThread(CAThread):
         self.window.errors = errors
         self.window.EpeakFactor = EpeakFactor
 
-    def handle_error(self, index):
+    def fit_failed(self, index, Win):
         wx.CallAfter(self.window.handle_error, index)
 
-    def run(self):
-        create_context()
-        
-        for i, cav in enumerate(self.window.cavity_set_phase[self.first_cavity_id:self.last_cavity_id + 1]):
-            index = i + self.first_cavity_id
-            if self.window.cavityList[index].startswith("buncher"):
-                EpeakFactor = 600
-            else:
-                EpeakFactor = 25
-
-            cav_readback = self.window.cavity_get_phase[index]
-            print self.window.cavity_get_phase[index]
-            x, y, std_errors = self.scan(index, cav, cav_readback)
-
-            distance = self.window.distance_cav_bpm[index]
-            twPhase = self.window.synch_phases[index]
-            fieldName = self.window.field_names[index]
-            step = self.phase_step * C.pi / 180
-            slope = self.window.slopes[index]
-
-            rfPhase, energy_gain, amp, e, x_plot, y_plot = self.fit(distance, twPhase, fieldName, step, slope, x, y, EpeakFactor)
-            if e < self.window.TOLERANCE:
-                self.prepare_for_next(rfPhase, energy_gain, amp, x_plot, y_plot)
-                if self.mode == 1:
-                    wx.CallAfter(self.window.clear_graph)
-                else:
-                    self.data_save(x, y, std_errors, distance, twPhase, fieldName, step, slope, EpeakFactor)
-            else:
-                self.handle_error(index)
-                break
+    def energies_propagated(self, index, cavities):
+        for row in cavities:
+            wx.CallAfter(self.window.display_frame.write_line, '%s\t%s\t%s' % (lattice.cavityList[row['index']], row['rfPhase'], row['Win_out']))
 
+    def finished(self):
         wx.CallAfter(self.window.reset_buttons)
-        destroy_context()
+
+class WorkThread(CAThread):
+    def __init__(self, window, Win, first_cavity_id, last_cavity_id, first_phase, last_phase, phase_step, delay_before_scan, delay_read, num_read, mode, adaptive=None, resume=False, rescan=None): 
+        CAThread.__init__(self)
+        self.window = window
+        self.engine = ScanEngine(Win, first_cavity_id, last_cavity_id, first_phase, last_phase, phase_step, delay_before_scan, delay_read, num_read, mode, [FrameObserver(window, mode)], adaptive=adaptive, archive=window.ARCHIVE_DIR,
+                                 telemetry=window.telemetry, session=window.SESSION_FILE, resume=resume, rescan=rescan)
+        self.timeToQuit = self.engine.timeToQuit
+        self.timeToPause = self.engine.timeToPause
+
+    @property
+    def pause(self):
+        return self.engine.pause
+
+    @pause.setter
+    def pause(self, value):
+        self.engine.pause = value
+
+    def run(self):
+        # an error the frame did not catch beforehand (see session_check)
+        # still ends in a message and enabled buttons
+        create_context()
+        try:
+            self.engine.run()
+        except Exception as exc:
+            wx.CallAfter(self.window.handle_error, None, str(exc))
+        finally:
+            destroy_context()
 
 class CanvasPanel(wx.Panel):
     def __init__(self, parent):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
+        from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar
         wx.Panel.__init__(self, parent, -1)
         self.figure = Figure()
         self.axes = self.figure.add_subplot(111)
@@ -169,6 +115,41 @@ class CanvasPanel(wx.Panel):
         self.sizer.Add(self.canvas, 1, wx.LEFT | wx.TOP | wx.GROW, 5)
         self.SetSizer(self.sizer)
 
+        # lines are animated: a full draw renders only the axes, which are
+        # kept as the blit background, and the lines are drawn on top of it
+        self.lines = []
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_lines()
+
+    def draw_lines(self):
+        for line in self.lines:
+            self.axes.draw_artist(line)
+        self.canvas.blit(self.axes.bbox)
+
+    def inside_view(self, line):
+        x, y = line.get_xdata(), line.get_ydata()
+        if not len(x):
+            return True
+        (x0, x1), (y0, y1) = sorted(self.axes.get_xlim()), sorted(self.axes.get_ylim())
+        return x0 <= np.min(x) and np.max(x) <= x1 and y0 <= np.min(y) and np.max(y) <= y1
+
+    def redraw(self):
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.canvas.draw()
+
+    def refresh(self, lines):
+        # blit when the new data fits the current view, rescale otherwise
+        if self.background is None or not all(self.inside_view(line) for line in lines):
+            self.redraw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.draw_lines()
+
 class DisplayFrame(wx.Frame):
     def __init__(self):
         wx.Frame.__init__(self, None, -1, 'Display parameters for each cavity')
@@ -183,21 +164,55 @@ class DisplayFrame(wx.Frame):
         self.text.WriteText(text)
         self.text.WriteText('\n')
 
+class TelemetryFrame(wx.Frame):
+    # live summary of the scan telemetry, refreshed every second while shown
+    def __init__(self, telemetry):
+        wx.Frame.__init__(self, None, -1, 'Scan telemetry')
+        self.telemetry = telemetry
+        panel = wx.Panel(self, -1)
+        self.text = wx.TextCtrl(panel, -1, "", style=wx.TE_MULTILINE | wx.TE_READONLY)
+        self.text.SetFont(wx.Font(9, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL, wx.FONTWEIGHT_NORMAL))
+
+        bsizer = wx.BoxSizer()
+        bsizer.Add(self.text, 1, wx.EXPAND)
+        panel.SetSizerAndFit(bsizer)
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.refresh, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+
+    def refresh(self, event=None):
+        self.text.SetValue(self.telemetry.summary())
+
+    def show(self):
+        self.refresh()
+        self.Show()
+        self.Raise()
+        self.timer.Start(1000)
+
+    def OnClose(self, event):
+        self.timer.Stop()
+        self.Hide()
+
 class MyFrame(wx.Frame):
-    cavity_set_phase = ['LLRF:Buncher1:PHA_SET', 'LLRF:Buncher2:PHA_SET', 'SCRF:CAV1:PHASE:SETPOINT', 'SCRF:CAV2:PHASE:SETPOINT', 'SCRF:CAV3:PHASE:SETPOINT', 'SCRF:CAV4:PHASE:SETPOINT', 'SCRF:CAV5:PHASE:SETPOINT', 'SCRF:CAV6:PHASE:SETPOINT', 'LLRF:CM2_Cavity1:PHA_SET', 'LLRF:CM2_Cavity2:PHA_SET', 'LLRF:CM2_Cavity3:PHA_SET', 'LLRF:CM2_Cavity4:PHA_SET', 'LLRF:CM2_Cavity5:PHA_SET', 'LLRF:CM2_Cavity6:PHA_SET']
-    cavity_get_phase = ['LLRF:Buncher1:CAVITY_PHASE', 'LLRF:Buncher2:CAVITY_PHASE', 'SCRF:CAV1:PHASE:SETPOINT', 'SCRF:CAV2:PHASE:SETPOINT', 'SCRF:CAV3:PHASE:SETPOINT', 'SCRF:CAV4:PHASE:SETPOINT', 'SCRF:CAV5:PHASE:SETPOINT', 'SCRF:CAV6:PHASE:SETPOINT', 'LLRF:CM2_Cavity1:PHA_SET', 'LLRF:CM2_Cavity2:PHA_SET', 'LLRF:CM2_Cavity3:PHA_SET', 'LLRF:CM2_Cavity4:PHA_SET', 'LLRF:CM2_Cavity5:PHA_SET', 'LLRF:CM2_Cavity6:PHA_SET']
-    bpm_pv = ['Bpm:2-P11', 'Bpm:5-P11', 'Bpm:6-P11', 'Bpm:7-P11', 'Bpm:8-P11', 'Bpm:9-P11', 'Bpm:10-P11', 'Bpm:11-P11', 'Bpm:12-P11', 'Bpm:13-P11', 'Bpm:14-P11', 'Bpm:15-P11', 'Bpm:16-P11', 'Bpm:17-P11']
-    distance_cav_bpm = [0.1, 0.15, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026, 0.1026]
-    field_names = ['buncher_field.txt', 'buncher_field.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt', 'Exyz.txt']
-    synch_phases = [-90, -90, -90, -90, -90, -90, -90, -90, -90, -90, -90, -90, -90, -90] 
-    slopes = [1, 1, 0.95, 0.95, 0.95, 0.95, 0.95, 0.95, 1, 1, 1, 1, 1, 1]  
+    cavity_set_phase = lattice.cavity_set_phase
+    cavity_get_phase = lattice.cavity_get_phase
+    bpm_pv = lattice.bpm_pv
+    distance_cav_bpm = lattice.distance_cav_bpm
+    field_names = lattice.field_names
+    synch_phases = lattice.synch_phases
+    slopes = lattice.slopes
     wildcard = "Phase files (*.txt)|*.txt|All files (*.*)|*.*"
-    TOLERANCE = 100
+    PLOT_INTERVAL = 50
+    ARCHIVE_DIR = 'archive'
+    FIT_CACHE_DIR = 'fitcache'
+    TELEMETRY_LOG = 'telemetry.jsonl'
+    SESSION_FILE = 'session.jsonl'
 
     def __init__(self):
         wx.Frame.__init__(self, None, -1, "PhaseScan")
         self.panel = wx.Panel(self, -1)
-        self.pltPanel = CanvasPanel(self) 
+        # stand-in of the default figure size until build_plot runs
+        self.pltPanel = wx.Panel(self, -1, size=(640, 520))
 
         menuBar = wx.MenuBar()
         file_menu = wx.Menu()
@@ -205,22 +220,31 @@ class MyFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.open, open_item)
         save_item = file_menu.Append(-1, "Save As")
         self.Bind(wx.EVT_MENU, self.save, save_item)
+        resume_item = file_menu.Append(-1, "Resume session")
+        self.Bind(wx.EVT_MENU, self.OnResume, resume_item)
+        rescan_item = file_menu.Append(-1, "Rescan begin cavity")
+        self.Bind(wx.EVT_MENU, self.OnRescan, rescan_item)
         menuBar.Append(file_menu, "File")
 
         graph_menu = wx.Menu()
         graph_clear_item = graph_menu.Append(-1, "Clear")
         self.Bind(wx.EVT_MENU, self.clear, graph_clear_item)
         menuBar.Append(graph_menu, "Graph")
+
+        view_menu = wx.Menu()
+        telemetry_item = view_menu.Append(-1, "Telemetry")
+        self.Bind(wx.EVT_MENU, self.show_telemetry, telemetry_item)
+        menuBar.Append(view_menu, "View")
         self.SetMenuBar(menuBar)
 
         sample_list = ['Manual', 'Auto']
         self.mode = wx.RadioBox(self.panel, -1, 'mode', wx.DefaultPosition, wx.DefaultSize, sample_list, 2, wx.RA_SPECIFY_COLS)
-        self.cavityList = ['buncher1', 'buncher2', 'hwr1', 'hwr2', 'hwr3', 'hwr4', 'hwr5', 'hwr6', 'hwr7', 'hwr8', 'hwr9', 'hwr10', 'hwr11', 'hwr12']
+        self.cavityList = lattice.cavityList
 
         self.start_cavity_name = wx.StaticText(self.panel, -1, 'Begin Cavity')
         self.end_cavity_name = wx.StaticText(self.panel, -1, 'End Cavity')
-        self.start_cavity = wx.ComboBox(self.panel, -1, 'buncher1', wx.DefaultPosition, wx.DefaultSize, self.cavityList, wx.CB_DROPDOWN)
-        self.end_cavity = wx.ComboBox(self.panel, -1, 'hwr12', wx.DefaultPosition, wx.DefaultSize, self.cavityList, wx.CB_DROPDOWN)
+        self.start_cavity = wx.ComboBox(self.panel, -1, self.cavityList[0], wx.DefaultPosition, wx.DefaultSize, self.cavityList, wx.CB_DROPDOWN)
+        self.end_cavity = wx.ComboBox(self.panel, -1, self.cavityList[-1], wx.DefaultPosition, wx.DefaultSize, self.cavityList, wx.CB_DROPDOWN)
 
         self.begin = wx.TextCtrl(self.panel, -1, '-178', size=(50, -1))
         self.current = wx.TextCtrl(self.panel, -1, '0', size=(50, -1))
@@ -229,6 +253,7 @@ class MyFrame(wx.Frame):
 
         self.stepLabel = wx.StaticText(self.panel, -1, 'SCAN with step:')
         self.step = wx.TextCtrl(self.panel, -1, '10', size=(50, -1))
+        self.adaptiveCheck = wx.CheckBox(self.panel, -1, 'adaptive')
         self.delayLabel = wx.StaticText(self.panel, -1, 'time delay after setting [sec]:')
         self.delay = wx.TextCtrl(self.panel, -1, '0.5', size=(50, -1))
 
@@ -267,6 +292,7 @@ class MyFrame(wx.Frame):
         stepSizer = wx.BoxSizer(wx.HORIZONTAL)
         stepSizer.Add(self.stepLabel, 0, wx.ALIGN_CENTRE | wx.ALL, 2)
         stepSizer.Add(self.step, 0, wx.ALL, 2)
+        stepSizer.Add(self.adaptiveCheck, 0, wx.ALIGN_CENTRE | wx.ALL, 2)
 
         delaySizer = wx.BoxSizer(wx.HORIZONTAL)
         delaySizer.Add(self.delayLabel, 0, wx.ALIGN_CENTRE | wx.ALL, 2)
@@ -303,11 +329,33 @@ class MyFrame(wx.Frame):
         sz.Add(self.pltPanel, 1, wx.ALL, 5)
         self.SetSizerAndFit(sz)
 
+        # no scan until there is a plot to draw it on
+        self.startButton.Disable()
         self.pauseButton.Disable()
         self.stopButton.Disable()
 
-        self.display_frame = DisplayFrame()
-        self.set_lines()
+        self.display_frame = None
+        self.telemetry = Telemetry(self.TELEMETRY_LOG)
+        self.telemetry_frame = None
+
+        # scan progress is posted from the worker thread as array snapshots
+        # and drawn at most PLOT_INTERVAL ms apart, coalescing the updates
+        self.plot_lock = threading.Lock()
+        self.pending_plots = {}
+        self.plot_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.flush_graph, self.plot_timer)
+        wx.CallAfter(self.build_plot)
+
+    def build_plot(self):
+        placeholder = self.pltPanel
+        with self.telemetry.span('startup_plot'):
+            self.pltPanel = CanvasPanel(self)
+            self.GetSizer().Replace(placeholder, self.pltPanel)
+            placeholder.Destroy()
+            self.Layout()
+            self.set_lines()
+        self.startButton.Enable()
+        self.plot_timer.Start(self.PLOT_INTERVAL)
 
     def save(self, event):
         if self.data_changed:
@@ -347,7 +395,7 @@ class MyFrame(wx.Frame):
             Win = float(self.injectEnergy.GetValue())
             first_phase = float(self.begin.GetValue())
 
-            rfPhase, energy_gain, amp, e, x_plot, y_plot = getTWPhase(x, y, Win, float(distance), float(twPhase), fieldName, float(step), first_phase, float(slope), float(EpeakFactor))
+            rfPhase, energy_gain, amp, e, x_plot, y_plot = FitCache(self.FIT_CACHE_DIR).getTWPhase(x, y, Win, float(distance), float(twPhase), fieldName, float(step), first_phase, float(slope), float(EpeakFactor))
             self.updateGraph(self.scan_line, x, y)
             self.updateGraph(self.fit_line, x_plot, y_plot)
             print rfPhase, energy_gain, amp
@@ -359,21 +407,12 @@ class MyFrame(wx.Frame):
             self.read_fit(filename)
         dlg.Destroy()
 
-    def load_config(self):
-        config_file = np.loadtxt(os.path.join(basedir, 'config.txt'))
-        cavity_set_phase = config_file[:, 0]
-        bpm_pv = config_file[:, 1]
-        distance_cav_bpm = config_file[:, 2]
-        field_names = config_file[:, 3]
-        synch_phases = config_file[:, 4]
-        slopes = config_file[:, 5]
-        return cavity_set_phase, bpm_pv, distance_cav_bpm, field_names, synch_phases, slopes
-
-
     def initiate(self):
         self.data_changed = False
         self.startButton.Disable()
         self.input_parameter()
+        if self.display_frame is None:
+            self.display_frame = DisplayFrame()
         self.display_frame.Show()
         self.data_list_init()
 
@@ -382,10 +421,14 @@ class MyFrame(wx.Frame):
         self.y = []
         self.errors = []
 
-    def handle_error(self, index):
-        wx.MessageBox('Some problem found', 'Error', wx.OK | wx.ICON_ERROR)
-        self.injectEnergy.SetValue(self.Win)
-        self.start_cavity.SetValue(self.cavityList[index])
+    def handle_error(self, index, message=None):
+        # index: cavity whose fit failed, None for an error of the scan itself
+        if index is None:
+            wx.MessageBox('Scan stopped\n\n%s' % message, 'Error', wx.OK | wx.ICON_ERROR)
+        else:
+            wx.MessageBox('Some problem found\n\nFile > Resume session continues the journaled session at %s' % self.cavityList[index], 'Error', wx.OK | wx.ICON_ERROR)
+            self.injectEnergy.SetValue(self.Win)
+            self.start_cavity.SetValue(self.cavityList[index])
         self.stop_thread()
         self.reset_buttons()
 
@@ -409,10 +452,12 @@ class MyFrame(wx.Frame):
         self.delay_read = float(self.avg_delay.GetValue())
         self.num_read = int(self.avg_num.GetValue())
         self.mode_value = self.mode.GetSelection()
+        self.adaptive = {} if self.adaptiveCheck.GetValue() else None
     
     def set_lines(self):
-        self.scan_line, = self.pltPanel.axes.plot([], [], marker='o')
-        self.fit_line, = self.pltPanel.axes.plot([], [], marker='o')
+        self.scan_line, = self.pltPanel.axes.plot([], [], marker='o', animated=True)
+        self.fit_line, = self.pltPanel.axes.plot([], [], marker='o', animated=True)
+        self.pltPanel.lines = [self.scan_line, self.fit_line]
 
     '''
     def resetCanvas(self):
@@ -423,6 +468,40 @@ class MyFrame(wx.Frame):
     '''
 
     def OnStart(self, event):
+        self.start_scan()
+
+    def OnResume(self, event):
+        # continue the journaled session where it stopped, at the energy
+        # reached there; the scan settings are taken from the window
+        if self.session_check():
+            self.start_scan(resume=True)
+
+    def OnRescan(self, event):
+        # scan the begin cavity again and update the journaled cavities
+        # behind it to the new energy from the model
+        rescan = self.cavityList.index(self.start_cavity.GetValue())
+        if self.session_check(rescan):
+            self.start_scan(rescan=rescan)
+
+    def session_check(self, rescan=None):
+        # the cases ScanEngine.open_session refuses, reported before the
+        # scan thread starts
+        from session import Session
+        if not self.startButton.IsEnabled():
+            return False
+        session = Session(self.SESSION_FILE)
+        if session.settings is None:
+            problem = 'No session journal in %s' % os.path.abspath(self.SESSION_FILE)
+        elif rescan is not None and session.energy_in(rescan) is None:
+            problem = 'No journaled energy in front of %s' % self.cavityList[rescan]
+        else:
+            problem = session.mismatch(self.cavityList)
+        if problem:
+            wx.MessageBox(problem, 'Error', wx.OK | wx.ICON_ERROR)
+            return False
+        return True
+
+    def start_scan(self, resume=False, rescan=None):
         self.initiate()
 
         if self.pauseButton.Enabled:
@@ -431,7 +510,8 @@ class MyFrame(wx.Frame):
         else:
             self.pauseButton.Enable()
 
-        self.thread = WorkThread(self, self.Win, self.first_cavity_id, self.last_cavity_id, self.first_phase, self.last_phase,  self.phase_step, self.delay_before_scan, self.delay_read, self.num_read, self.mode_value)
+        self.thread = WorkThread(self, self.Win, self.first_cavity_id, self.last_cavity_id, self.first_phase, self.last_phase,  self.phase_step, self.delay_before_scan, self.delay_read, self.num_read, self.mode_value, self.adaptive,
+                                 resume, rescan)
         self.thread.start()
 
         self.stopButton.Enable()
@@ -459,18 +539,45 @@ class MyFrame(wx.Frame):
     def OnCloseWindow(self, event):
         if self.stopButton.Enabled:
             self.OnStop(event)
+        self.plot_timer.Stop()
+        if self.display_frame:
+            self.display_frame.Destroy()
+        if self.telemetry_frame:
+            self.telemetry_frame.timer.Stop()
+            self.telemetry_frame.Destroy()
+        self.telemetry.close()
         self.Destroy()
 
+    def show_telemetry(self, event):
+        if self.telemetry_frame is None:
+            self.telemetry_frame = TelemetryFrame(self.telemetry)
+        self.telemetry_frame.show()
+
     def getBpmPhase(self, value):
         self.bpm_phase.SetValue(str(value))
 
     def updateGraph(self, line, x, y):
-        plotPanel = self.pltPanel
         line.set_xdata(x)
         line.set_ydata(y)
-        plotPanel.axes.relim()
-        plotPanel.axes.autoscale_view()
-        plotPanel.canvas.draw()
+        self.pltPanel.redraw()
+
+    def post_graph(self, line, x, y):
+        # callable from any thread; only the latest data per line is kept
+        x = np.array(x, dtype=float)
+        y = np.array(y, dtype=float)
+        x.setflags(write=False)
+        y.setflags(write=False)
+        with self.plot_lock:
+            self.pending_plots[line] = (x, y)
+
+    def flush_graph(self, event=None):
+        with self.plot_lock:
+            pending, self.pending_plots = self.pending_plots, {}
+        if pending:
+            with self.telemetry.span('redraw', lines=len(pending)):
+                for line, (x, y) in pending.items():
+                    line.set_data(x, y)
+                self.pltPanel.refresh(list(pending))
 
     def updateStatusBar(self, event):
         if event.inaxes:
@@ -478,14 +585,20 @@ class MyFrame(wx.Frame):
             self.statusBar.SetStatusText(('x= ' + str(x) + ' y=' + str(y)), 0)
 
     def clear_graph(self):
+        with self.plot_lock:
+            self.pending_plots.clear()
         self.updateGraph(self.scan_line, [], [])
         self.updateGraph(self.fit_line, [], [])
 
 
 if __name__ == '__main__':
+    import sys
+    lattice.configure(sys.argv[1] if len(sys.argv) > 1 else lattice.defaultPath)
     app = wx.App()
     frame = MyFrame()
     frame.Show(True)
+    # process start to the window on screen, before the plot is built
+    frame.telemetry.record('startup', started, time.time() - started)
     app.MainLoop()
 
 
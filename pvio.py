@@ -0,0 +1,179 @@
+import time
+import threading
+import numpy as np
+
+# Event-driven PV access for the scan loop.
+#
+# SetpointChannel puts a cavity phase with put-completion and then waits for
+# its readback monitor to confirm the new value, instead of sleeping a fixed
+# time. BpmChannel collects BPM phases from monitor updates, counting only
+# samples that arrive after a point has settled, keeping them in a
+# preallocated ring buffer and averaging them as phases. Both take the PV
+# class (or
+# any factory with the pyepics PV(name, callback=...) signature) from the
+# caller, so the scan engine decides what they talk to.
+
+class SetpointChannel(object):
+    def __init__(self, setpoint, readback, PV, tolerance=5, timeout=5.):
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.target = None
+        self.previous = None
+        self.value = None
+        self.settled = threading.Event()
+        self.echo = setpoint == readback
+        self.setpoint = PV(setpoint)
+        self.readback = PV(readback, callback=self.on_readback)
+
+    def on_readback(self, value=None, **kw):
+        self.value = value
+        if self.target is not None and self.is_settled(value):
+            self.settled.set()
+
+    def is_settled(self, value):
+        if value is None or abs(value - self.target) >= self.tolerance:
+            return False
+        # a readback still at the previous setpoint does not count, however
+        # small the step
+        return self.previous is None or abs(value - self.target) <= abs(value - self.previous)
+
+    def put(self, value, quit=None):
+        # re-issue the put every timeout seconds until the readback follows
+        # (like the old buncher loop); returns False if quit is set first
+        self.begin(value, wait=True)
+        return self.wait(quit)
+
+    def begin(self, value, wait=False):
+        # issue a put without waiting for the readback, so several channels
+        # can move at once; wait() then collects the readback
+        self.previous, self.target = self.target, value
+        self.settled.clear()
+        self.setpoint.put(value, wait=wait, timeout=self.timeout)
+
+    def wait(self, quit=None):
+        # only a readback update after the put settles it; without one, the
+        # last readback is accepted once it is nearer the new setpoint than
+        # the old one (a put of an unchanged value posts no update)
+        while quit is None or not quit.isSet():
+            if self.settled.wait(self.timeout) or self.is_settled(self.value):
+                return True
+            self.settled.clear()
+            self.setpoint.put(self.target, wait=True, timeout=self.timeout)
+        return False
+
+def wrap(phase):
+    return (phase + 180.) % 360. - 180.
+
+def circularMean(phases):
+    rad = np.radians(phases)
+    return np.degrees(np.arctan2(np.mean(np.sin(rad)), np.mean(np.cos(rad))))
+
+def phaseStatistics(phases, reject=3.):
+    # circular mean and spread of BPM phases [deg]; samples further than
+    # reject robust standard deviations (1.4826 MAD) from the median are
+    # dropped. Returns mean, std and the mask of samples used.
+    phases = np.asarray(phases, dtype=float)
+    deviation = wrap(phases - circularMean(phases))
+    used = np.ones(len(phases), dtype=bool)
+    if reject and len(phases) > 2:
+        median = np.median(deviation)
+        mad = np.median(np.abs(deviation - median))
+        if mad > 0:
+            used = np.abs(deviation - median) <= reject * 1.4826 * mad
+    mean = circularMean(phases[used])
+    return mean, np.std(wrap(phases[used] - mean)), used
+
+class SampleBuffer(object):
+    # fixed-size ring of (timestamp, value) rows; count is the number of
+    # samples ever appended, so a saved count marks where fresh data starts
+    def __init__(self, capacity=1024):
+        self.data = np.empty((capacity, 2))
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def append(self, value, timestamp=None):
+        with self.condition:
+            self.data[self.count % len(self.data)] = (time.time() if timestamp is None else timestamp, value)
+            self.count += 1
+            self.condition.notify_all()
+
+    def since(self, mark):
+        with self.condition:
+            n = min(self.count - mark, len(self.data))
+            rows = np.arange(self.count - n, self.count) % len(self.data)
+            return self.data[rows]
+
+    def wait(self, mark, n, deadline, quit=None):
+        with self.condition:
+            while self.count - mark < n:
+                remaining = deadline - time.time()
+                if remaining <= 0 or (quit is not None and quit.isSet()):
+                    return False
+                self.condition.wait(min(remaining, 0.1))
+            return True
+
+class BpmChannel(object):
+    def __init__(self, name, PV, capacity=1024, reject=3.):
+        self.buffer = SampleBuffer(capacity)
+        self.reject = reject
+        self.mark = None
+        self.polled = 0
+        self.failed = 0
+        self.pv = PV(name, callback=self.on_update)
+
+    def on_update(self, value=None, timestamp=None, **kw):
+        if value is not None:
+            self.buffer.append(value, timestamp)
+
+    def start(self):
+        # only updates after this call count for the next read
+        self.mark = self.buffer.count
+
+    def read(self, num_read, timeout, quit=None, delay=0.):
+        # wait until num_read fresh samples survive the outlier cut, or until
+        # timeout; a BPM that does not update at all is then polled with
+        # get() for up to another timeout, delay seconds apart so the polls
+        # are not copies of one reading. polled counts the polls and failed
+        # the ones that got nothing (a disconnected PV). Returns mean, std,
+        # the fresh (timestamp, phase) rows and the mask of rows used; mean
+        # and std are nan without any row.
+        if self.mark is None:
+            self.start()
+        deadline = time.time() + timeout
+        need = num_read
+        while True:
+            self.buffer.wait(self.mark, need, deadline, quit)
+            samples = self.buffer.since(self.mark)
+            if len(samples) == 0 or time.time() >= deadline or (quit is not None and quit.isSet()):
+                break
+            mean, std, used = phaseStatistics(samples[:, 1], self.reject)
+            if used.sum() >= num_read:
+                break
+            need = len(samples) + num_read - used.sum()
+        self.polled = 0
+        self.failed = 0
+        deadline = time.time() + timeout
+        while len(samples) < num_read and time.time() < deadline and (quit is None or not quit.isSet()):
+            if self.polled + self.failed and delay > 0:
+                if quit is None:
+                    time.sleep(delay)
+                elif quit.wait(delay):
+                    break
+            value = self.pv.get()
+            if value is None:
+                # disconnected
+                self.failed += 1
+                continue
+            self.buffer.append(value)
+            self.polled += 1
+            samples = self.buffer.since(self.mark)
+        self.mark = None
+        if len(samples) == 0:
+            return np.nan, np.nan, samples, np.zeros(0, dtype=bool)
+        mean, std, used = phaseStatistics(samples[:, 1], self.reject)
+        # average only the most recent num_read accepted samples
+        recent = used & (np.cumsum(used[::-1])[::-1] <= num_read)
+        if recent.sum() < used.sum():
+            used = recent
+            mean, std = phaseStatistics(samples[used, 1], 0)[:2]
+        return mean, std, samples, used
@@ -0,0 +1,204 @@
+import os
+import sys
+import argparse
+import multiprocessing
+import scipy.constants as C
+import lattice
+
+# Headless refit of saved phase scans.
+#
+# Scan files are either the '<cavity>.txt' files written during a scan
+# (phase, average, rms per line) or files saved from the GUI, which carry a
+# 'distance twPhase fieldName step slope EpeakFactor' header line. Files of
+# one directory form a chain: they are fitted in lattice order and, like
+# WorkThread.prepare_for_next, each fitted energy gain is added to the
+# injection energy of the next cavity. Chains, or single files with
+# independent=True, are spread over a process pool. Given num_read, the
+# fits are weighted by the rms column and lattice.MODEL_SIGMA (see
+# leastsq.bpmSigma) and accepted by the chi^2 test at lattice.SIGNIFICANCE.
+
+columns = ['file', 'cavity', 'Win', 'rfPhase', 'energy_gain', 'amp', 'error', 'status', 'sigma_rfPhase', 'sigma_energy', 'chi2', 'p_value']
+
+def isHeader(line):
+    # 'distance twPhase fieldName step slope EpeakFactor'; a field map row
+    # has only numbers
+    fields = line.strip().split()
+    if len(fields) != 6:
+        return False
+    try:
+        float(fields[2])
+    except ValueError:
+        return True
+    return False
+
+def readScan(filename):
+    f = open(filename, 'r')
+    data = f.readlines()
+    f.close()
+    header = None
+    if isHeader(data[0]):
+        distance, twPhase, fieldName, step, slope, EpeakFactor = data[0].strip().split()
+        header = dict(distance=float(distance), twPhase=float(twPhase), fieldName=fieldName, step=float(step), slope=float(slope), EpeakFactor=float(EpeakFactor))
+        data = data[1:]
+    x = []
+    y = []
+    errors = []
+    for line in data:
+        line_data = line.strip().split()
+        if not line_data:
+            continue
+        x.append(float(line_data[0]))
+        y.append(float(line_data[1]))
+        errors.append(float(line_data[2]) if len(line_data) > 2 else 0.)
+    return header, x, y, errors
+
+def cavityName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def scanParameters(filename, header, x, fieldDir):
+    name = cavityName(filename)
+    if header is None:
+        if name not in lattice.cavityList:
+            raise ValueError('%s: no header and %r is not a lattice cavity' % (filename, name))
+        index = lattice.cavityList.index(name)
+        header = dict(distance=lattice.distance_cav_bpm[index], twPhase=lattice.synch_phases[index], fieldName=lattice.field_names[index],
+                      step=(x[1] - x[0]) * C.pi / 180, slope=lattice.slopes[index], EpeakFactor=lattice.EpeakFactor(index))
+    params = dict(header)
+    params['fieldName'] = os.path.join(fieldDir, params['fieldName'])
+    return params
+
+def latticeOrder(filename):
+    name = cavityName(filename)
+    if name in lattice.cavityList:
+        return lattice.cavityList.index(name), name
+    return len(lattice.cavityList), name
+
+def fitChain(job):
+    # fit the files of one chain in order, propagating the injection energy;
+    # the chain stops at the first fit that fails the acceptance test
+    filenames, Win, fieldDir, cache, integrator, num_read, options = job
+    import leastsq
+    leastsq.setIntegrator(integrator)
+    if cache:
+        from fitcache import FitCache
+        getTWPhase = FitCache(cache).getTWPhase
+    else:
+        from leastsq import getTWPhase
+    def accepted(e, info):
+        if info['p_value'] is not None:
+            return info['p_value'] >= lattice.SIGNIFICANCE
+        return e < lattice.TOLERANCE
+
+    rows = []
+    failed = False
+    for filename in filenames:
+        row = dict(file=filename, cavity=cavityName(filename), Win=Win)
+        if failed:
+            row['status'] = 'skipped'
+            rows.append(row)
+            continue
+        try:
+            header, x, y, errors = readScan(filename)
+            p = scanParameters(filename, header, x, fieldDir)
+            args = (x, y, Win, p['distance'], p['twPhase'], p['fieldName'], p['step'], x[0], p['slope'], p['EpeakFactor'])
+            kw = dict(options, uniform=header is not None, full_output=True)
+            if num_read:
+                kw['sigma'] = leastsq.bpmSigma(errors, num_read, lattice.MODEL_SIGMA)
+            rfPhase, energy_gain, amp, e, x_plot, y_plot, info = getTWPhase(*args, **kw)
+            if not accepted(e, info) and options.get('method') != 'global':
+                # a local fit stuck in the wrong minimum, try the global fit
+                rfPhase, energy_gain, amp, e, x_plot, y_plot, info = getTWPhase(*args, **dict(kw, method='global'))
+        except Exception as exc:
+            row['status'] = 'error: %s' % exc
+            failed = True
+            rows.append(row)
+            continue
+        row.update(rfPhase=rfPhase, energy_gain=energy_gain, amp=amp, error=e, sigma_rfPhase=info['sigma_rfPhase'], sigma_energy=info['sigma_energy'],
+                   chi2=info['chi2'], p_value=info['p_value'])
+        if accepted(e, info):
+            row['status'] = 'ok'
+            Win += energy_gain
+        else:
+            row['status'] = 'failed'
+            failed = True
+        rows.append(row)
+    return rows
+
+def isScanFile(filename):
+    if cavityName(filename) in lattice.cavityList:
+        return True
+    with open(filename, 'r') as f:
+        return isHeader(f.readline())
+
+def scanFiles(paths, exclude=()):
+    # files named on the command line are taken as they are; of a directory
+    # only the scan files, so field maps and result tables are skipped
+    exclude = set(os.path.abspath(path) for path in exclude)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.endswith('.txt') and isScanFile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    return [filename for filename in files if os.path.abspath(filename) not in exclude]
+
+def refit(paths, Win, processes=None, independent=False, fieldDir='.', cache=None, integrator='kick', num_read=None, exclude=(), **options):
+    # exclude: files never to fit, such as the output table
+    files = scanFiles(paths, exclude)
+    if independent:
+        chains = [[filename] for filename in files]
+    else:
+        groups = {}
+        for filename in files:
+            groups.setdefault(os.path.dirname(os.path.abspath(filename)), []).append(filename)
+        chains = [sorted(groups[d], key=latticeOrder) for d in sorted(groups)]
+    jobs = [(chain, Win, fieldDir, cache, integrator, num_read, options) for chain in chains]
+    if processes == 1 or len(jobs) <= 1:
+        results = [fitChain(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(fitChain, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [row for rows in results for row in rows]
+
+def writeTable(rows, filename):
+    f = open(filename, 'w')
+    f.write('#%s\n' % '\t'.join(columns))
+    for row in rows:
+        f.write('%s\n' % '\t'.join(str(row.get(key, '')) for key in columns))
+    f.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refit saved phase scans.')
+    parser.add_argument('paths', nargs='+', help='scan files or directories of scan files')
+    parser.add_argument('--win', type=float, required=True, help='injection energy of the first cavity of each chain [MeV]')
+    parser.add_argument('-o', '--output', default='refit_results.txt')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--independent', action='store_true', help='fit every file on its own at --win instead of chaining energies')
+    parser.add_argument('--field-dir', default='.', help='directory holding the field map files')
+    parser.add_argument('--lattice', default=lattice.defaultPath, help='lattice configuration file')
+    parser.add_argument('--method', default='leastsq', choices=['leastsq', 'least_squares', 'global'])
+    parser.add_argument('--integrator', default='kick', choices=['kick', 'rk4'], help='tracking integrator of the fit model')
+    parser.add_argument('--surrogate', action='store_true', help='use the transit-time-factor surrogate where it is accurate enough')
+    parser.add_argument('--weighted', action='store_true', help='weight the fits by the rms column and the lattice model_sigma and accept them by a chi^2 test')
+    parser.add_argument('--num-read', type=int, default=5, help='weighted: BPM readings averaged per point')
+    parser.add_argument('--cache', default='fitcache', help='directory of the fit-result cache')
+    parser.add_argument('--no-cache', dest='cache', action='store_const', const=None, help='always fit')
+    args = parser.parse_args(argv)
+    try:
+        lattice.configure(args.lattice, args.field_dir)
+    except (lattice.LatticeError, OSError, IOError) as exc:
+        parser.error(str(exc))
+
+    num_read = args.num_read if args.weighted else None
+    rows = refit(args.paths, args.win, args.processes, args.independent, args.field_dir, args.cache, args.integrator, num_read, [args.output], method=args.method, surrogate=args.surrogate)
+    writeTable(rows, args.output)
+    for row in rows:
+        sys.stdout.write('%s\t%s\t%s\n' % (row['cavity'], row.get('rfPhase', ''), row['status']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,578 @@
+import sys
+import math
+import time
+import threading
+import argparse
+import lattice
+from pvio import SetpointChannel, BpmChannel
+from telemetry import Telemetry
+
+# GUI-free scan -> fit -> next cavity loop.
+#
+# ScanEngine drives the cavity phase and BPM PVs and fits each scan; it knows
+# nothing about wx. Progress is reported to observers (ScanObserver
+# subclasses), one of which is the wx frame when run from phasescan.py.
+# pyepics and the fit code are only imported once a scan or fit starts, so
+# importing this module stays cheap on display-less nodes.
+
+class ScanObserver(object):
+    def scan_started(self, index, first_phase, last_phase):
+        pass
+
+    def phase_set(self, index, phase):
+        pass
+
+    def point_measured(self, index, x, y, errors):
+        pass
+
+    def cavity_fitted(self, index, rfPhase, Win, amp, x_plot, y_plot):
+        pass
+
+    def cavity_done(self, index, scan):
+        pass
+
+    def fit_failed(self, index, Win):
+        pass
+
+    def energies_propagated(self, index, cavities):
+        pass
+
+    def finished(self):
+        pass
+
+class GridPlan(object):
+    # the fixed first_phase..last_phase grid, in order
+    def __init__(self, phases):
+        self.phases = list(phases)
+
+    def next_phase(self, x, y, errors):
+        if len(x) < len(self.phases):
+            return self.phases[len(x)]
+        return None
+
+    def skip(self, phase):
+        self.phases.remove(phase)
+
+class ScanEngine(object):
+    # adaptive: None for the fixed grid, or a dict of adaptive.AdaptivePlan
+    # options (possibly empty) to choose the grid points adaptively
+    # archive: directory of an archive.py scan archive to stream raw data to
+    # method: leastsq.fitScan method; a fit failing the acceptance test is
+    # retried with the global fit before the scan is given up
+    # parallel: in manual mode, number of consecutive cavities scanned
+    # interleaved, one point of each in turn (see scan_group); auto mode
+    # scans one cavity at a time
+    # telemetry: telemetry.Telemetry receiving the timing spans of the scan
+    # weighted: weight the fits by the BPM rms of each point plus the model
+    # error lattice.MODEL_SIGMA (see leastsq.bpmSigma) and accept them by a
+    # chi^2 test at lattice.SIGNIFICANCE instead of lattice.TOLERANCE; the
+    # test rejects good scans if model_sigma in lattice.json is too small
+    # bootstrap: number of bootstrap refits estimating the rfPhase spread
+    # session: path of a session.Session journal of the accepted cavities; a
+    # new run starts a new journal, resume=True continues the journaled one
+    # at its first cavity without a result, and rescan=index scans that one
+    # cavity again and moves the journaled cavities behind it to the new
+    # energy with the linac model
+    def __init__(self, Win, first_cavity_id, last_cavity_id, first_phase, last_phase, phase_step, delay_before_scan, delay_read, num_read, mode, observers=(), PV=None, adaptive=None, archive=None, method='leastsq', parallel=1,
+                 telemetry=None, weighted=False, bootstrap=0, session=None, resume=False, rescan=None):
+        self.Win = Win
+        self.first_cavity_id = first_cavity_id
+        self.last_cavity_id = last_cavity_id
+        self.first_phase = first_phase
+        self.last_phase = last_phase
+        self.phase_step = phase_step
+        self.delay_before_scan = delay_before_scan
+        self.delay_read = delay_read
+        self.num_read = num_read
+        self.mode = mode
+        self.observers = list(observers)
+        self.PV = PV
+        self.adaptive = adaptive
+        self.archive = archive
+        self.method = method
+        if parallel > 1 and mode != 0:
+            raise ValueError('parallel scans need the manual mode')
+        self.parallel = parallel
+        self.telemetry = telemetry or Telemetry()
+        self.weighted = weighted
+        self.bootstrap = bootstrap
+        self.session = session
+        self.resume = resume
+        self.rescan = rescan
+        self.journal = None
+        self.run_writer = None
+        # setpoint each scanned cavity is left at, the reference of its fit
+        # for the linac model
+        self.held = {}
+        self._linac = None
+        self.timeout = 5.
+
+        self.timeToQuit = threading.Event()
+        self.timeToPause = threading.Event()
+        self.pause = False
+
+    @property
+    def linac(self):
+        # calibrated by every accepted fit, for predictions across the linac;
+        # built on first use, as it pulls in the fit code
+        if self._linac is None:
+            from linac import Linac
+            self._linac = Linac()
+        return self._linac
+
+    @linac.setter
+    def linac(self, value):
+        self._linac = value
+
+    def notify(self, event, *args):
+        for observer in self.observers:
+            getattr(observer, event)(*args)
+
+    def connect(self, name, callback=None):
+        if self.PV is None:
+            from epics import PV
+            self.PV = PV
+        return self.PV(name, callback=callback)
+
+    def scan(self, index):
+        x = []
+        y = []
+        std_errors = []
+
+        name = lattice.cavityList[index]
+        started = time.time()
+        f = open('%s.%s' % (name, 'txt'), 'w')
+        self.notify('scan_started', index, self.first_phase, self.last_phase)
+        with self.telemetry.span('connect', cavity=name):
+            self.cavity = SetpointChannel(lattice.cavity_set_phase[index], lattice.cavity_get_phase[index], self.connect)
+            self.bpm = BpmChannel(lattice.bpm_pv[index], self.connect)
+
+        plan = self.plan(index)
+        writer = self.run_writer.cavity(name) if self.run_writer else None
+
+        while True:
+            with self.telemetry.span('plan', cavity=name):
+                first_phase = plan.next_phase(x, y, std_errors)
+            if first_phase is None or self.timeToQuit.isSet():
+                break
+            if self.pause:
+                with self.telemetry.span('pause', cavity=name):
+                    self.timeToPause.wait()
+
+            point = time.time()
+            self.notify('phase_set', index, first_phase)
+            with self.telemetry.span('put', cavity=name, phase=first_phase):
+                settled = self.cavity.put(first_phase, self.timeToQuit)
+            if not settled:
+                break
+            if self.cavity.echo:
+                # the readback is the setpoint itself, so give the cavity
+                # the configured time to follow
+                with self.telemetry.span('settle', cavity=name, phase=first_phase):
+                    self.timeToQuit.wait(self.delay_before_scan)
+
+            self.bpm.start()
+            with self.telemetry.span('read', cavity=name, phase=first_phase):
+                average, rms, samples, used = self.bpm.read(self.num_read, self.num_read * self.delay_read + self.timeout, self.timeToQuit, self.delay_read)
+            self.count_samples(name, samples, used, self.bpm.polled, self.bpm.failed)
+            if self.timeToQuit.isSet():
+                break
+            if len(samples) == 0:
+                # no reading at all (BPM disconnected): leave the point out
+                plan.skip(first_phase)
+                self.telemetry.counter('skipped', 1, cavity=name)
+                continue
+            if writer:
+                writer.append(first_phase, self.cavity.value, average, rms, samples, used, self.bpm.polled)
+
+            f.write('%s\t' % first_phase)
+            f.write('%s\t' % average)
+            f.write('%s\n' % rms)
+
+            x.append(first_phase)
+            y.append(average)
+            std_errors.append(rms)
+            self.notify('point_measured', index, list(x), list(y), list(std_errors))
+            self.telemetry.record('point', point, time.time() - point, cavity=name, phase=first_phase)
+
+        f.close()
+        if writer:
+            writer.close()
+        self.held[index] = self.cavity.value
+        self.telemetry.record('scan', started, time.time() - started, cavity=name, points=len(x))
+        return x, y, std_errors
+
+    def count_samples(self, name, samples, used, polled, failed=0):
+        self.telemetry.counter('samples', len(samples), cavity=name)
+        if polled:
+            self.telemetry.counter('polled', polled, cavity=name)
+        if failed:
+            self.telemetry.counter('failed', failed, cavity=name)
+        if len(used) > used.sum():
+            self.telemetry.counter('rejected', int(len(used) - used.sum()), cavity=name)
+
+    def scan_group(self, group):
+        # Interleaved scan of consecutive cavities: the cavities take turns,
+        # one point each, and only the cavity whose BPM is read is off its
+        # reference (pre-scan) setpoint, so every scan sees the others where
+        # a serial scan of the group would. Moving the next cavity and
+        # returning the previous one happen at once, with both readbacks
+        # awaited together. Returns the raw scans.
+        cavities = {}
+        bpms = {}
+        plans = {}
+        writers = {}
+        data = dict((index, ([], [], [])) for index in group)
+        names = [lattice.cavityList[index] for index in group]
+        started = time.time()
+        for index in group:
+            self.notify('scan_started', index, self.first_phase, self.last_phase)
+            with self.telemetry.span('connect', cavity=lattice.cavityList[index]):
+                cavities[index] = SetpointChannel(lattice.cavity_set_phase[index], lattice.cavity_get_phase[index], self.connect)
+                bpms[index] = BpmChannel(lattice.bpm_pv[index], self.connect)
+            plans[index] = self.plan(index)
+            writers[index] = self.run_writer.cavity(lattice.cavityList[index]) if self.run_writer else None
+        reference = {}
+        for index in group:
+            value = cavities[index].value
+            if value is None:
+                value = cavities[index].readback.get()
+            if value is None:
+                raise ValueError('%s: no readback of the phase setpoint' % lattice.cavityList[index])
+            reference[index] = value
+        moved = None
+
+        active = list(group)
+        while active and not self.timeToQuit.isSet():
+            for index in list(active):
+                if self.timeToQuit.isSet():
+                    break
+                if self.pause:
+                    with self.telemetry.span('pause', cavity=names):
+                        self.timeToPause.wait()
+                name = lattice.cavityList[index]
+                phase = plans[index].next_phase(*data[index])
+                if phase is None:
+                    active.remove(index)
+                    continue
+                point = time.time()
+                self.notify('phase_set', index, phase)
+                cavities[index].begin(phase)
+                channels = [cavities[index]]
+                if moved not in (None, index):
+                    cavities[moved].begin(reference[moved])
+                    channels.append(cavities[moved])
+                moved = index
+                with self.telemetry.span('put', cavity=name, phase=phase):
+                    settled = all(channel.wait(self.timeToQuit) for channel in channels)
+                if not settled:
+                    break
+                if any(channel.echo for channel in channels):
+                    with self.telemetry.span('settle', cavity=name, phase=phase):
+                        self.timeToQuit.wait(self.delay_before_scan)
+
+                bpms[index].start()
+                with self.telemetry.span('read', cavity=name, phase=phase):
+                    average, rms, samples, used = bpms[index].read(self.num_read, self.num_read * self.delay_read + self.timeout, self.timeToQuit, self.delay_read)
+                self.count_samples(name, samples, used, bpms[index].polled, bpms[index].failed)
+                if self.timeToQuit.isSet():
+                    break
+                if len(samples) == 0:
+                    plans[index].skip(phase)
+                    self.telemetry.counter('skipped', 1, cavity=name)
+                    continue
+                if writers[index]:
+                    writers[index].append(phase, cavities[index].value, average, rms, samples, used, bpms[index].polled)
+                x, y, std_errors = data[index]
+                x.append(phase)
+                y.append(average)
+                std_errors.append(rms)
+                self.notify('point_measured', index, list(x), list(y), list(std_errors))
+                self.telemetry.record('point', point, time.time() - point, cavity=name, phase=phase)
+
+        if moved is not None and not self.timeToQuit.isSet():
+            # the last cavity back to its reference as well
+            cavities[moved].put(reference[moved], self.timeToQuit)
+        for index in group:
+            if writers[index]:
+                writers[index].close()
+            self.held[index] = reference[index]
+        self.telemetry.record('scan', started, time.time() - started, cavity=names, points=sum(len(data[index][0]) for index in group))
+        return data
+
+    def grid(self):
+        phases = []
+        phase = self.first_phase
+        while ((self.last_phase - phase) * self.phase_step > 0):
+            phases.append(phase)
+            phase += self.phase_step
+        return phases
+
+    def plan(self, index):
+        if self.adaptive is None:
+            return GridPlan(self.grid())
+        from adaptive import AdaptivePlan
+        options = dict(self.adaptive)
+        if self.weighted:
+            options.setdefault('num_read', self.num_read)
+            options.setdefault('model_sigma', lattice.MODEL_SIGMA)
+        return AdaptivePlan(self.grid(), self.first_phase, self.Win, lattice.distance_cav_bpm[index], lattice.field_names[index], lattice.slopes[index], **options)
+
+    def fit(self, distance, twPhase, fieldName, step, slope, x, y, EpeakFactor, method=None, sigma=None):
+        from leastsq import getTWPhase
+        rfPhase, energy_gain, amp, e, x_plot, y_plot, self.fit_info = getTWPhase(x, y, self.Win, distance, twPhase, fieldName, step, self.first_phase, slope, EpeakFactor,
+                                                                                 method=method or self.method, uniform=self.adaptive is None, full_output=True,
+                                                                                 sigma=sigma, bootstrap=self.bootstrap)
+        return rfPhase, energy_gain, amp, e, x_plot, y_plot
+
+    def accepted(self, e):
+        # chi^2 test for a weighted fit, the residual spread otherwise
+        if self.fit_info.get('p_value') is not None:
+            return self.fit_info['p_value'] >= lattice.SIGNIFICANCE
+        return e < lattice.TOLERANCE
+
+    def fit_record(self, fields, e):
+        fields.update(error=float(e), sigma_rfPhase=float(self.fit_info['sigma_rfPhase']), p_value=self.fit_info.get('p_value'))
+        if 'bootstrap' in self.fit_info:
+            fields['bootstrap_rfPhase'] = float(self.fit_info['bootstrap']['sigma_rfPhase'])
+
+    def prepare_for_next(self, index, rfPhase, energy_gain, amp, x_plot, y_plot):
+        self.Win += energy_gain
+        #self.cavity_pv.put(rfPhase)
+        self.notify('cavity_fitted', index, rfPhase, self.Win, amp, x_plot, y_plot)
+
+    def fit_scan(self, index, x, y, std_errors):
+        # fit one scan and move on to the next cavity; False if the fit
+        # fails the acceptance test
+        cavity = lattice.current[index]
+        EpeakFactor = cavity.epeak_factor
+        if self.adaptive is not None and x:
+            x, y, std_errors = [list(v) for v in zip(*sorted(zip(x, y, std_errors)))]
+
+        distance = cavity.distance
+        twPhase = cavity.synch_phase
+        fieldName = cavity.field
+        step = self.phase_step * math.pi / 180
+        slope = cavity.slope
+
+        sigma = None
+        if self.weighted:
+            from leastsq import bpmSigma
+            sigma = bpmSigma(std_errors, self.num_read, lattice.MODEL_SIGMA)
+
+        with self.telemetry.span('fit', cavity=cavity.name, method=self.method, points=len(x)) as fields:
+            rfPhase, energy_gain, amp, e, x_plot, y_plot = self.fit(distance, twPhase, fieldName, step, slope, x, y, EpeakFactor, sigma=sigma)
+            self.fit_record(fields, e)
+        if not self.accepted(e) and self.method != 'global':
+            with self.telemetry.span('fit', cavity=cavity.name, method='global', points=len(x)) as fields:
+                rfPhase, energy_gain, amp, e, x_plot, y_plot = self.fit(distance, twPhase, fieldName, step, slope, x, y, EpeakFactor, 'global', sigma)
+                self.fit_record(fields, e)
+        if self.accepted(e):
+            Win = self.Win
+            self.linac.calibrate(index, self.fit_info['p'], self.fit_info['start_phase'], self.held.get(index))
+            self.prepare_for_next(index, rfPhase, energy_gain, amp, x_plot, y_plot)
+            if self.journal:
+                self.journal.cavity_done(index, cavity.name, Win_in=Win, Win_out=self.Win, rfPhase=rfPhase, energy_gain=energy_gain, amp=amp, error=e,
+                                         p=self.fit_info['p'], start_phase=self.fit_info['start_phase'], reference=self.held.get(index), sigma_rfPhase=self.fit_info['sigma_rfPhase'],
+                                         p_value=self.fit_info.get('p_value'), x=x, y=y, errors=std_errors)
+            scan = dict(x=x, y=y, errors=std_errors, distance=distance, twPhase=twPhase, fieldName=fieldName, step=step, slope=slope, EpeakFactor=EpeakFactor)
+            self.notify('cavity_done', index, scan)
+            return True
+        if self.journal:
+            self.journal.cavity_failed(index, cavity.name, self.Win)
+        self.notify('fit_failed', index, self.Win)
+        return False
+
+    def open_session(self):
+        # new journal, or pick up the cavity range and energy from the
+        # journaled session for resume and rescan
+        from session import Session
+        if not self.resume and self.rescan is None:
+            self.journal = Session.create(self.session, Win=self.Win, first_cavity=self.first_cavity_id, last_cavity=self.last_cavity_id,
+                                          cavities=lattice.cavityList[self.first_cavity_id:self.last_cavity_id + 1], first_phase=self.first_phase,
+                                          last_phase=self.last_phase, phase_step=self.phase_step, num_read=self.num_read, mode=self.mode, method=self.method)
+            return
+        self.journal = Session(self.session)
+        if self.journal.settings is None:
+            raise ValueError('%s: no session to resume' % self.session)
+        self.journal.calibrate(self.linac)
+        if self.rescan is not None:
+            Win = self.journal.energy_in(self.rescan)
+            if Win is None:
+                raise ValueError('%s: no journaled energy in front of %s' % (self.session, lattice.cavityList[self.rescan]))
+            self.first_cavity_id = self.last_cavity_id = self.rescan
+        else:
+            index, Win = self.journal.resume_point()
+            self.last_cavity_id = self.journal.settings['last_cavity']
+            # past the last cavity when the session is complete
+            self.first_cavity_id = self.last_cavity_id + 1 if index is None else index
+            if index is not None:
+                self.journal.resume(index, Win)
+        self.Win = Win
+
+    def run(self):
+        if self.session:
+            self.open_session()
+            if self.first_cavity_id > self.last_cavity_id:
+                # resumed a session that is already complete
+                self.journal.close()
+                self.notify('finished')
+                return
+        if self.archive:
+            from archive import RunWriter
+            self.run_writer = RunWriter(self.archive, Win=self.Win, first_cavity=lattice.cavityList[self.first_cavity_id], last_cavity=lattice.cavityList[self.last_cavity_id],
+                                        first_phase=self.first_phase, last_phase=self.last_phase, phase_step=self.phase_step, num_read=self.num_read, mode=self.mode)
+        indices = list(range(self.first_cavity_id, self.last_cavity_id + 1))
+        size = max(self.parallel, 1)
+        failed = False
+        for start in range(0, len(indices), size):
+            group = indices[start:start + size]
+            if len(group) == 1:
+                scans = {group[0]: self.scan(group[0])}
+            else:
+                scans = self.scan_group(group)
+            if self.timeToQuit.isSet():
+                break
+            for index in group:
+                x, y, std_errors = scans[index]
+                if len(group) > 1:
+                    f = open('%s.%s' % (lattice.cavityList[index], 'txt'), 'w')
+                    for row in zip(x, y, std_errors):
+                        f.write('%s\t%s\t%s\n' % row)
+                    f.close()
+                if not self.fit_scan(index, x, y, std_errors):
+                    failed = True
+                    break
+            if failed:
+                break
+
+        if self.rescan is not None and self.journal and not failed and not self.timeToQuit.isSet():
+            cavities = self.journal.propagate(self.linac, self.rescan, self.journal.settings['last_cavity'])
+            if cavities:
+                self.Win = cavities[-1]['Win_out']
+            self.notify('energies_propagated', self.rescan, cavities)
+        if self.journal:
+            self.journal.close()
+        self.telemetry.flush()
+        self.notify('finished')
+
+class ConsoleObserver(ScanObserver):
+    # tag: prefix point lines with the cavity name, for interleaved scans
+    def __init__(self, stream=sys.stdout, tag=False):
+        self.stream = stream
+        self.tag = tag
+
+    def write(self, text):
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+    def scan_started(self, index, first_phase, last_phase):
+        self.write('# scanning %s from %s to %s' % (lattice.cavityList[index], first_phase, last_phase))
+
+    def point_measured(self, index, x, y, errors):
+        if self.tag:
+            self.write('%s\t%s\t%s\t%s' % (lattice.cavityList[index], x[-1], y[-1], errors[-1]))
+        else:
+            self.write('%s\t%s\t%s' % (x[-1], y[-1], errors[-1]))
+
+    def cavity_fitted(self, index, rfPhase, Win, amp, x_plot, y_plot):
+        self.write('%s\t%s\t%s' % (rfPhase, Win, amp))
+
+    def fit_failed(self, index, Win):
+        self.write('# fit of %s failed, Win = %s' % (lattice.cavityList[index], Win))
+
+    def energies_propagated(self, index, cavities):
+        for row in cavities:
+            self.write('# %s\t%s\t%s' % (lattice.cavityList[row['index']], row['rfPhase'], row['Win_out']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run cavity phase scans without the GUI.')
+    parser.add_argument('--win', type=float, default=2.1, help='injection energy [MeV]')
+    parser.add_argument('--lattice', default=lattice.defaultPath, help='lattice configuration file')
+    parser.add_argument('--first', help='first cavity (default: first of the lattice)')
+    parser.add_argument('--last', help='last cavity (default: last of the lattice)')
+    parser.add_argument('--begin', type=float, default=-178, help='first phase [deg]')
+    parser.add_argument('--end', type=float, default=180, help='last phase [deg]')
+    parser.add_argument('--step', type=int, default=10, help='phase step [deg]')
+    parser.add_argument('--delay', type=float, default=0.5, help='time delay after setting [sec]')
+    parser.add_argument('--num-read', type=int, default=5, help='BPM readings averaged per point')
+    parser.add_argument('--delay-read', type=float, default=1, help='delay between BPM readings [sec]')
+    parser.add_argument('--mode', choices=['manual', 'auto'], default='auto')
+    parser.add_argument('--adaptive', action='store_true', help='choose scan points adaptively and stop once the fit is constrained')
+    parser.add_argument('--target-error', type=float, default=1., help='adaptive: residual std to reach [deg]')
+    parser.add_argument('--target-phase', type=float, default=1., help='adaptive: cavity phase uncertainty to reach [deg]')
+    parser.add_argument('--archive', help='directory of the binary scan archive to append to')
+    parser.add_argument('--method', default='leastsq', choices=['leastsq', 'least_squares', 'global'], help='fit method')
+    parser.add_argument('--integrator', default='kick', choices=['kick', 'rk4'], help='tracking integrator of the fit model')
+    parser.add_argument('--parallel', type=int, default=1, help='manual mode: cavities scanned together')
+    parser.add_argument('--weighted', action='store_true', help='weight the fits by the BPM rms and the lattice model_sigma and accept them by a chi^2 test')
+    parser.add_argument('--bootstrap', type=int, default=0, help='bootstrap refits per scan estimating the rfPhase spread')
+    parser.add_argument('--session', help='journal every accepted cavity to this file, to resume or rescan later')
+    parser.add_argument('--resume', action='store_true', help='continue the --session journal at its first cavity without a result')
+    parser.add_argument('--rescan', help='scan this cavity of the --session journal again and move the energies behind it')
+    parser.add_argument('--telemetry', help='append timing spans to this JSON-lines log and print a summary at the end')
+    parser.add_argument('--simulate', action='store_true', help='scan a simulated beamline instead of the machine PVs')
+    parser.add_argument('--noise', type=float, default=0.5, help='simulate: BPM noise [deg rms]')
+    parser.add_argument('--settle', type=float, default=0.2, help='simulate: cavity settling time [sec]')
+    parser.add_argument('--seed', type=int, default=0, help='simulate: random seed of the cavity phases and noise')
+    parser.add_argument('--sim-surrogate', action='store_true', help='simulate: faster beam model, off the fit model (see linac.py)')
+    args = parser.parse_args(argv)
+    try:
+        lattice.configure(args.lattice)
+    except (lattice.LatticeError, OSError, IOError) as exc:
+        parser.error(str(exc))
+    first = args.first or lattice.cavityList[0]
+    last = args.last or lattice.cavityList[-1]
+    for name in (first, last):
+        if name not in lattice.cavityList:
+            parser.error('unknown cavity %r, choose from %s' % (name, ', '.join(lattice.cavityList)))
+    if args.parallel > 1 and args.mode != 'manual':
+        parser.error('--parallel needs --mode manual')
+    if (args.resume or args.rescan) and not args.session:
+        parser.error('--resume and --rescan need --session')
+    if args.resume and args.rescan:
+        parser.error('--resume and --rescan are exclusive')
+    if args.rescan and args.rescan not in lattice.cavityList:
+        parser.error('unknown cavity %r, choose from %s' % (args.rescan, ', '.join(lattice.cavityList)))
+    rescan = lattice.cavityList.index(args.rescan) if args.rescan else None
+    if args.resume or args.rescan:
+        # the cases ScanEngine.open_session refuses, as usage errors
+        from session import Session
+        session = Session(args.session)
+        if session.settings is None:
+            parser.error('%s: no session to resume' % args.session)
+        if rescan is not None and session.energy_in(rescan) is None:
+            parser.error('%s: no journaled energy in front of %s' % (args.session, args.rescan))
+        problem = session.mismatch(lattice.cavityList)
+        if problem:
+            parser.error(problem)
+    adaptive = dict(target_error=args.target_error, target_phase=args.target_phase) if args.adaptive else None
+
+    if args.integrator != 'kick':
+        import leastsq
+        leastsq.setIntegrator(args.integrator)
+
+    beamline = None
+    if args.simulate:
+        from simulator import Beamline
+        beamline = Beamline(args.win, noise=args.noise, settle=args.settle, seed=args.seed, surrogate=args.sim_surrogate).start()
+
+    engine = ScanEngine(args.win, lattice.cavityList.index(first), lattice.cavityList.index(last), args.begin, args.end, args.step,
+                        args.delay, args.delay_read, args.num_read, ['manual', 'auto'].index(args.mode), [ConsoleObserver(tag=args.parallel > 1)],
+                        PV=beamline.PV if beamline else None, adaptive=adaptive, archive=args.archive, method=args.method, parallel=args.parallel,
+                        telemetry=Telemetry(args.telemetry), weighted=args.weighted, bootstrap=args.bootstrap, session=args.session, resume=args.resume, rescan=rescan)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        engine.timeToQuit.set()
+        return 1
+    finally:
+        if beamline:
+            beamline.stop()
+        if args.telemetry:
+            engine.telemetry.close()
+            sys.stdout.write('# ' + engine.telemetry.summary().replace('\n', '\n# ') + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+from fitcache import plain
+
+# Resumable journal of a multi-cavity scan session.
+#
+# The journal is a JSON-lines file: a 'session' line with the settings of
+# the run (cavity range, injection energy, scan parameters), then one line
+# per event
+#
+#   {"event": "cavity", "index": 3, "cavity": "hwr2", "Win_in": 2.31, "Win_out": 2.52,
+#    "rfPhase": -41.2, "p": [c, phase_in, offset], "start_phase": -178, "reference": 162, "x": [...], ...}
+#   {"event": "failed", "index": 4, "cavity": "hwr3", "Win": 2.52}
+#   {"event": "resume", "index": 4, "Win": 2.52}
+#   {"event": "propagated", "index": 3, "cavities": [{"index": 4, "Win_in": ..., "Win_out": ..., "rfPhase": ...}, ...]}
+#
+# Every line is flushed and synced as it is written, so a crash or a closed
+# window loses at most the cavity in progress; a torn last line is ignored
+# on reading. Replaying the journal gives the latest accepted result per
+# cavity. resume_point() is the first cavity of the range without one, with
+# the energy chained up to it, and calibrate() restores the linac model from
+# the journaled fits. After one cavity is scanned again, propagate() moves
+# the energies and synchronous setpoints of the journaled cavities behind it
+# with the calibrated linac.Linac instead of scanning them again.
+
+class Session(object):
+    def __init__(self, path):
+        self.path = path
+        self.settings = None
+        self.cavities = {}
+        self.failed = None
+        self.stream = None
+        if os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def create(cls, path, **settings):
+        # a new session; the previous journal is kept as '<path>.prev'
+        if os.path.exists(path):
+            os.rename(path, path + '.prev')
+        session = cls(path)
+        session.write(dict(settings, event='session'))
+        return session
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.apply(record)
+
+    def apply(self, record):
+        event = record['event']
+        if event == 'session':
+            self.settings = record
+            self.cavities = {}
+            self.failed = None
+        elif event == 'cavity':
+            self.cavities[record['index']] = record
+            if self.failed and self.failed['index'] == record['index']:
+                self.failed = None
+        elif event == 'failed':
+            self.failed = record
+        elif event == 'propagated':
+            for row in record['cavities']:
+                self.cavities[row['index']] = dict(self.cavities[row['index']], **row)
+
+    def write(self, record):
+        record = plain(dict(record, t=time.time()))
+        self.apply(record)
+        if self.stream is None:
+            self.stream = open(self.path, 'a')
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def cavity_done(self, index, name, **result):
+        self.write(dict(result, event='cavity', index=index, cavity=name))
+
+    def cavity_failed(self, index, name, Win):
+        self.write(dict(event='failed', index=index, cavity=name, Win=Win))
+
+    def energy_in(self, index):
+        # energy in front of cavity index along the journaled chain, None if
+        # the chain does not reach it
+        if index - 1 in self.cavities:
+            return self.cavities[index - 1]['Win_out']
+        if index in self.cavities:
+            return self.cavities[index]['Win_in']
+        if self.settings and index == self.settings['first_cavity']:
+            return self.settings['Win']
+        return None
+
+    def resume_point(self):
+        # (first cavity without an accepted fit, energy in front of it);
+        # the index is None once the whole range is done
+        Win = self.settings['Win']
+        for index in range(self.settings['first_cavity'], self.settings['last_cavity'] + 1):
+            if index not in self.cavities:
+                return index, Win
+            Win = self.cavities[index]['Win_out']
+        return None, Win
+
+    def resume(self, index, Win):
+        self.write(dict(event='resume', index=index, Win=Win))
+
+    def mismatch(self, names):
+        # why the journal does not fit a lattice with these cavity names, or
+        # None if it does
+        for index, record in sorted(self.cavities.items()):
+            if index >= len(names) or names[index] != record['cavity']:
+                return '%s: cavity %d is %r in the journal but %r in the lattice' % (self.path, index, record['cavity'], names[index] if index < len(names) else None)
+        return None
+
+    def calibrate(self, linac):
+        problem = self.mismatch(linac.names)
+        if problem:
+            raise ValueError(problem)
+        for index, record in sorted(self.cavities.items()):
+            linac.calibrate(index, record['p'], record['start_phase'], record.get('reference'))
+
+    def propagate(self, linac, index, last):
+        # energies and setpoints of the journaled cavities following index,
+        # up to last or the first cavity without a result, from the model
+        stop = index
+        while stop < last and stop + 1 in self.cavities:
+            stop += 1
+        if stop == index:
+            return []
+        setpoints, energies = linac.design_setpoints(self.cavities[index]['Win_out'], index + 1, stop)
+        rows = [dict(index=k, Win_in=energies[i], Win_out=energies[i + 1], energy_gain=energies[i + 1] - energies[i], rfPhase=setpoints[i]) for i, k in enumerate(range(index + 1, stop + 1))]
+        self.write(dict(event='propagated', index=index, cavities=rows))
+        return rows
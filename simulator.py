@@ -0,0 +1,179 @@
+import time
+import threading
+import numpy as np
+import lattice
+from linac import Linac
+from pvio import wrap
+
+# In-process stand-in for the machine's PVs, for offline end-to-end scans.
+#
+# Beamline serves the cavity setpoint/readback and BPM PV names of the
+# current lattice configuration. The beam is a linac.Linac calibrated with
+# seeded random cavity phases, one amplitude for all cavities and BPM offsets
+# centred on the initial BPM phases, so every BPM phase follows the same
+# model the fit uses. The cavities are referenced to their initial
+# setpoints, so moving one also delays the beam at every cavity and BPM
+# behind it (see linac.py).
+#
+# A cavity put is echoed on the setpoint PV at once and the new beam is
+# tracked from that moment, from the moved cavity on (linac.Linac caches the
+# upstream part). The beam changes `settle` seconds after the put, or once
+# it is tracked if that takes longer, and a separate readback PV follows a
+# further `lag` later. Until then the BPMs hold back their updates, so a
+# BPM update after a put always shows the new beam. BPMs publish the model phase
+# plus Gaussian noise of `noise` degrees rms at `rate` Hz, wrapped like the
+# real ones. Beamline.PV has the pyepics PV(name, callback=...) signature and
+# plugs into ScanEngine(PV=...). surrogate=True tracks with the
+# transit-time-factor surrogate instead, which is faster but off the fit
+# model (see linac.py), enough to fail weighted fits.
+
+class SimPV(object):
+    def __init__(self, beamline, name, callback=None):
+        self.beamline = beamline
+        self.pvname = name
+        self.callbacks = [callback] if callback else []
+        self.value = beamline.value(name)
+        beamline.subscribe(self)
+        # like a pyepics monitor, report the current value on connection
+        if callback:
+            callback(pvname=name, value=self.value, timestamp=time.time())
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def get(self, **kw):
+        return self.value
+
+    def put(self, value, wait=False, timeout=None, **kw):
+        self.beamline.put(self.pvname, value)
+        return 1
+
+    def post(self, value, timestamp=None):
+        self.value = value
+        for callback in self.callbacks:
+            callback(pvname=self.pvname, value=value, timestamp=timestamp or time.time())
+
+class Beamline(object):
+    def __init__(self, Win=2.1, fieldDir='.', noise=0.5, settle=0.2, lag=0.05, rate=20., amplitude=0.5, seed=0, surrogate=False):
+        self.Win = Win
+        self.noise = noise
+        self.settle = settle
+        self.lag = lag
+        self.rate = rate
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self.tracking = threading.Lock()
+        self.posting = threading.Lock()
+        self.pvs = {}
+        self.setpoint_pv = dict((cavity.set_pv, cavity.index) for cavity in lattice.current)
+        self.readback_pv = dict((cavity.get_pv, cavity.index) for cavity in lattice.current)
+        self.bpm_pv = dict((cavity.bpm_pv, cavity.index) for cavity in lattice.current)
+        self.linac = Linac(fieldDir, surrogate)
+        n = len(self.linac.names)
+        self.setpoints = np.zeros(n)
+        self.readbacks = np.zeros(n)
+        for index in range(n):
+            self.linac.calibrate(index, (amplitude, self.random.uniform(-np.pi, np.pi), 0.), 0., 0.)
+        offsets = -self.linac.track(Win, self.setpoints)[1] + self.random.uniform(-30, 30, n)
+        for index in range(n):
+            self.linac.calibrate(index, (amplitude, self.linac.phase_in[index], offsets[index]), 0., 0.)
+        self.version = 0
+        self.published = 0
+        # due times of puts whose beam is not published yet; the BPMs are
+        # silent while there are any
+        self.waiting = {}
+        beam = self.beam()
+        with self.lock:
+            self.publish(*beam)
+        self.timeToQuit = threading.Event()
+        self.thread = None
+
+    def beam(self):
+        # serialised, so a beam tracked after a put includes its setpoint;
+        # returns the version of the setpoints it was tracked for
+        with self.tracking:
+            with self.lock:
+                setpoints, version = self.setpoints.copy(), self.version
+            energies, phases = self.linac.track(self.Win, setpoints)
+        return energies, phases, version
+
+    def publish(self, energies, phases, version):
+        # under self.lock; an older beam never replaces a newer one
+        if version >= self.published:
+            self.energies, self.phases, self.published = energies, phases, version
+
+    def value(self, name):
+        if name in self.setpoint_pv:
+            return self.setpoints[self.setpoint_pv[name]]
+        if name in self.readback_pv:
+            return self.readbacks[self.readback_pv[name]]
+        if name in self.bpm_pv:
+            return self.bpm(self.bpm_pv[name])
+        raise KeyError('no simulated PV %r' % (name,))
+
+    def bpm(self, index):
+        with self.lock:
+            phase = self.phases[index]
+        return float(wrap(phase + self.random.normal(0, self.noise)))
+
+    def subscribe(self, pv):
+        self.pvs.setdefault(pv.pvname, []).append(pv)
+
+    def post(self, name, value):
+        for pv in self.pvs.get(name, []):
+            pv.post(value)
+
+    def put(self, name, value):
+        if name not in self.setpoint_pv:
+            raise KeyError('simulated PV %r is read-only' % (name,))
+        index = self.setpoint_pv[name]
+        self.post(name, value)
+        # once the put returns, no BPM update of the old beam is in flight
+        with self.posting:
+            with self.lock:
+                self.setpoints[index] = value
+                self.version += 1
+                key = self.version
+                self.waiting[key] = time.time() + self.settle
+        thread = threading.Thread(target=self.settled, args=(index, name, value, key))
+        thread.daemon = True
+        thread.start()
+
+    def settled(self, index, name, value, key):
+        beam = self.beam()
+        delay = self.waiting[key] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.publish(*beam)
+            self.readbacks[index] = value
+            del self.waiting[key]
+        readback = lattice.current[index].get_pv
+        if readback != name:
+            threading.Timer(self.lag, self.post, (readback, value)).start()
+
+    def PV(self, name, callback=None):
+        return SimPV(self, name, callback)
+
+    def run(self):
+        while not self.timeToQuit.wait(1. / self.rate):
+            with self.posting:
+                with self.lock:
+                    hold = bool(self.waiting)
+                if hold:
+                    continue
+                for name, index in self.bpm_pv.items():
+                    if self.pvs.get(name):
+                        self.post(name, self.bpm(index))
+
+    def start(self):
+        self.timeToQuit.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.timeToQuit.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,110 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+# Timing spans and counters for the scan loop.
+#
+# span(name, **fields) times a block; counter(name, n) adds to a count. Both
+# are aggregated in memory (count, total, max per name) for summary(), and,
+# given a path, every span and counter is also appended to a JSON-lines log
+#
+#   {"t": 1700000000.12, "span": "read", "dt": 0.512, "cavity": "hwr1", "phase": -178}
+#   {"t": 1700000000.64, "counter": "samples", "n": 5, "cavity": "hwr1"}
+#
+# with t the wall-clock start. Spans from the scan thread and the GUI thread
+# go to the same log. Running this module summarises a log.
+
+class Telemetry(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stream = open(path, 'a') if path else None
+        self.spans = {}
+        self.counters = {}
+
+    def write(self, record):
+        # the stream is checked under the lock, as close() may run on
+        # another thread (the GUI closing mid-scan)
+        line = json.dumps(record)
+        with self.lock:
+            if self.stream is not None:
+                self.stream.write(line + '\n')
+
+    def record(self, name, start, dt, **fields):
+        with self.lock:
+            count, total, longest = self.spans.get(name, (0, 0., 0.))
+            self.spans[name] = (count + 1, total + dt, max(longest, dt))
+        fields.update(t=start, span=name, dt=dt)
+        self.write(fields)
+
+    @contextmanager
+    def span(self, name, **fields):
+        start = time.time()
+        try:
+            yield fields
+        finally:
+            self.record(name, start, time.time() - start, **fields)
+
+    def counter(self, name, n=1, **fields):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        fields.update(t=time.time(), counter=name, n=n)
+        self.write(fields)
+
+    def flush(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def summary(self):
+        with self.lock:
+            return table(dict(self.spans), dict(self.counters))
+
+def table(spans, counters):
+    lines = ['%-12s%8s%10s%10s%10s' % ('span', 'count', 'total', 'mean', 'max')]
+    for name in sorted(spans, key=lambda name: -spans[name][1]):
+        count, total, longest = spans[name]
+        lines.append('%-12s%8d%10.3f%10.4f%10.4f' % (name, count, total, total / count, longest))
+    for name in sorted(counters):
+        lines.append('%-12s%8d' % (name, counters[name]))
+    return '\n'.join(lines)
+
+def summarise(path, by=None):
+    # aggregate a log, optionally per value of one field (e.g. 'cavity')
+    groups = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            key = record.get(by) if by else None
+            if isinstance(key, list):
+                key = ','.join(str(v) for v in key)
+            spans, counters = groups.setdefault(key, ({}, {}))
+            if 'span' in record:
+                count, total, longest = spans.get(record['span'], (0, 0., 0.))
+                spans[record['span']] = (count + 1, total + record['dt'], max(longest, record['dt']))
+            else:
+                counters[record['counter']] = counters.get(record['counter'], 0) + record['n']
+    return groups
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarise a telemetry log.')
+    parser.add_argument('path')
+    parser.add_argument('--by', help='group by this field, e.g. cavity')
+    args = parser.parse_args(argv)
+    groups = summarise(args.path, args.by)
+    for key in sorted(groups, key=str):
+        if args.by:
+            sys.stdout.write('# %s = %s\n' % (args.by, key))
+        sys.stdout.write(table(*groups[key]) + '\n')
+
+if __name__ == '__main__':
+    main()
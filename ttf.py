@@ -0,0 +1,100 @@
+import numpy as np
+import scipy.constants as C
+import fieldmap
+from leastsq import mass, w, omega, energyGain
+
+# Transit-time-factor surrogate for the field-map tracking in leastsq.py.
+#
+# At constant velocity the energy kick through the map only depends on beta
+# through T = sum(kick * cos(theta)) and S = sum(kick * sin(theta)), with
+# theta = omega * z / (beta * c). Expanding the time of flight to first order
+# in the energy gain adds the two moment sums Ic, Is. All of them are smooth
+# in 1/beta, so they are tabulated once on a dense 1/beta grid and every
+# energyGain / calTraceWinPhase / getEntrPhase becomes a few interpolations.
+# The expansion is first order in c: it is exact enough for weak cavities and
+# getTWPhase checks it against the full tracker before trusting a fit.
+
+tables = {}
+
+def getTable(fieldName, l, dz, Ez):
+    key = fieldmap.identity(fieldName) + (l, dz)
+    if key not in tables:
+        tables[key] = TTFTable(l, dz, Ez)
+    return tables[key]
+
+def beta(W):
+    return (1 - (W / mass + 1) ** -2) ** 0.5
+
+class TTFTable(object):
+    def __init__(self, l, dz, Ez, Wmin=0.5, Wmax=50., resolution=0.01, chunk=256):
+        self.l = l
+        self.dz = dz
+        self.Wmin = Wmin
+        self.Wmax = Wmax
+        n = l - 1
+        self.length = n * dz
+        kick = 0.5 * (Ez[:l - 1] + Ez[1:l]) * dz
+        j = np.arange(n)
+        moment = kick * (n - j - 0.5) * dz
+        # theta is linear in u = 1/beta with slope omega * length / c, so a
+        # fixed phase resolution per grid step sets the grid density.
+        uMin, uMax = 1 / beta(Wmax), 1 / beta(Wmin)
+        points = int(np.ceil((uMax - uMin) * omega * self.length / C.c / resolution)) + 2
+        self.u = np.linspace(uMin, uMax, points)
+        self.T, self.S, self.Ic, self.Is, self.Tm, self.Sm = [np.empty(points) for i in range(6)]
+        for start in range(0, points, chunk):
+            u = self.u[start:start + chunk]
+            theta = np.outer(u * omega / C.c, j * dz)
+            cos, sin = np.cos(theta), np.sin(theta)
+            self.T[start:start + chunk] = cos.dot(kick)
+            self.S[start:start + chunk] = sin.dot(kick)
+            self.Ic[start:start + chunk] = cos.dot(moment)
+            self.Is[start:start + chunk] = sin.dot(moment)
+            theta += (u * omega * 0.5 * dz / C.c)[:, None]
+            self.Tm[start:start + chunk] = np.cos(theta, out=cos).dot(kick)
+            self.Sm[start:start + chunk] = np.sin(theta, out=sin).dot(kick)
+
+    def covers(self, Win):
+        return self.Wmin <= Win <= self.Wmax
+
+    def lookup(self, Win, *names):
+        u = 1 / beta(np.asarray(Win, dtype=float))
+        return [np.interp(u, self.u, getattr(self, name)) for name in names]
+
+    def timeSensitivities(self, Win, c, phase_in, distance):
+        T, S, Ic, Is = self.lookup(Win, 'T', 'S', 'Ic', 'Is')
+        b = beta(np.asarray(Win, dtype=float))
+        gamma = Win / mass + 1
+        k = 1 / (mass * gamma ** 3 * b) / (b ** 2 * C.c)
+        A = Ic + distance * T
+        B = Is + distance * S
+        cos, sin = np.cos(phase_in), np.sin(phase_in)
+        dt_dc = -k * (A * cos - B * sin)
+        t = (self.length + distance) / (b * C.c) + c * dt_dc
+        dt_dphi = k * c * (A * sin + B * cos)
+        return t, dt_dc, dt_dphi
+
+    def energyGain(self, Win, c, phase_in, distance):
+        t = self.timeSensitivities(Win, c, phase_in, distance)[0]
+        return -(w * t) * 180 * 2
+
+    def calTraceWinPhase(self, Win, c, phase_in):
+        Tm, Sm = self.lookup(Win, 'Tm', 'Sm')
+        cos, sin = np.cos(phase_in), np.sin(phase_in)
+        a = c * (Tm * sin + Sm * cos)
+        b = c * (Tm * cos - Sm * sin)
+        return np.arctan2(a, b), a, b
+
+    def getEntrPhase(self, twPhase, Win, c):
+        Tm, Sm = self.lookup(Win, 'Tm', 'Sm')
+        phi = twPhase - np.arctan2(Sm, Tm)
+        if c < 0:
+            phi += C.pi
+        return (phi + C.pi) % (2 * C.pi) - C.pi
+
+    def deviation(self, Win, p, x, distance, l, dz, Ez):
+        # largest disagreement with the full tracker over the scan once the
+        # constant part, which the fitted offset absorbs, is removed
+        c, phase_in, offset = p
+        err = energyGain(Win, c, phase_in + x, distance, l, dz, Ez) - self.energyGain(Win, c, phase_in + x, distance)
+        return np.abs(err - np.mean(err)).max()